@@ -0,0 +1,61 @@
+#!/bin/python3
+
+"""
+Cross-checks and times the max flow backends of simulator_clean on random trusted node
+key graphs shaped like the ones R2_regular builds (every ordered pair of trusted nodes is an
+arc, only arcs from lower to higher node carry capacity).
+
+	python maxflow_benchmark.py [trials] [max trusted nodes]
+"""
+from __future__ import print_function
+import random
+import sys
+import time
+import collections
+
+import simulator_clean as sim
+
+def random_key_graph(rand, max_trusted):
+	T = sorted(rand.sample(range(0, 441), rand.randint(2, max_trusted)))
+	start_nodes, end_nodes, capacities = [],[],[]
+	for i in T:
+		for j in T:
+			start_nodes.append(i)
+			end_nodes.append(j)
+			capacities.append(rand.randint(0, 5000) if i < j and rand.random() < .7 else 0)
+	return start_nodes, end_nodes, capacities, T[0], T[-1]
+
+def check_flow(start_nodes, end_nodes, capacities, source, sink, value, flows):
+	# flows must respect capacities and be conserved everywhere but source and sink
+	net = collections.Counter()
+	for (u, v, c, f) in zip(start_nodes, end_nodes, capacities, flows):
+		if f < 0 or f > c:
+			return False
+		net[u] -= f
+		net[v] += f
+	return net[sink] == value and all([net[v] == 0 for v in net if v != source and v != sink])
+
+def main(trials = 200, max_trusted = 10):
+	rand = random.Random(0)
+	graphs = [random_key_graph(rand, max_trusted) for i in range(trials)]
+	values = {}
+	for name in sorted(sim.MAXFLOW_BACKENDS):
+		try:
+			solver = sim.MAXFLOW_BACKENDS[name]()
+		except ImportError as e:
+			print("{:>10}: unavailable ({})".format(name, e))
+			continue
+		start = time.time()
+		values[name] = [solver.solve(*g) for g in graphs]
+		elapsed = time.time() - start
+		valid = all([check_flow(*(g + r)) for (g, r) in zip(graphs, values[name])])
+		print("{:>10}: {:8.2f} ms/solve, flows valid: {}".format(name, 1000*elapsed/trials, valid))
+	names = sorted(values)
+	agree = all([len(set([values[name][k][0] for name in names])) == 1 for k in range(trials)])
+	print("max flow values agree across {}: {}".format(", ".join(names), agree))
+	return agree
+
+if __name__ == '__main__':
+	trials = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	max_trusted = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+	sys.exit(0 if main(trials, max_trusted) else 1)
@@ -0,0 +1,40 @@
+#!/bin/python3
+
+"""
+Node failure resilience of the topologies in NodeFailureSim.m, in place of the four
+NodeFailureSim_VM*.m copies: one run covers both routers' settings and uses every core.
+
+	python node_failure_sim.py [global|local] [networks] [rounds] [fiber km] [workers] [seed]
+
+Writes results/node-failures/T-2-corners_<router>-router_<km>.csv.
+"""
+from __future__ import print_function
+import os
+import sys
+
+import numpy as np
+import simulator_clean as sim
+
+def topologies():
+	# 3x3 regular, 5x5 rewired and 5x5 regular with the two corners trusted
+	return [sim.GridGraph(3, [0, 8]), sim.SmallWorldGraph(5, [0, 24], seed=0), sim.GridGraph(5, [0, 24])]
+
+def main(glob = True, networks = 1000, rounds = 1000, km = 50, workers = None, seed = None):
+	# the MATLAB scripts spread km/sqrt(2) of fiber over each grid's side, at .15 dB/km
+	segment = [km / np.sqrt(2) / (3 - 1), km / np.sqrt(2) / (5 - 1), km / np.sqrt(2) / (5 - 1)]
+	p = [10 ** (-.15 * L / 10) for L in segment]
+	failure_range = [round(x, 2) for x in np.arange(.1, .5001, .05)]
+	filename = os.path.join("results", "node-failures", "T-2-corners_{}-router_{:g}.csv".format("global" if glob else "local", km))
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with open(filename, "w") as f:
+		return sim.node_failure_sim(topologies(), failure_range, networks, rounds, p, .85, .02, glob=glob, workers=workers, seed=seed, file=f)
+
+if __name__ == '__main__':
+	glob = (sys.argv[1] if len(sys.argv) > 1 else "global") == "global"
+	networks = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+	rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+	km = float(sys.argv[4]) if len(sys.argv) > 4 else 50
+	workers = int(sys.argv[5]) if len(sys.argv) > 5 else None
+	seed = int(sys.argv[6]) if len(sys.argv) > 6 else None
+	sim.set_log_level()
+	main(glob, networks, rounds, km, workers, seed)
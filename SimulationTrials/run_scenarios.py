@@ -0,0 +1,197 @@
+#!/bin/python3
+
+"""
+Runs batches of simulator_clean.main scenarios described in JSON or TOML files, in place of
+editing simulator_clean's __main__ block or gather_all_data's ranges.
+
+	python run_scenarios.py batch.toml [more.json ...] [--workers 4] [--dry-run] [--log-level INFO]
+
+Top level keys of a batch are defaults for each of its [[scenario]] tables, e.g.
+
+	N = 10000
+	output = "results/batch"         # a ResultStore (npz parts, .parquet or .h5) or a .csv file
+	checkpoint = "results/batch.ckpt" # optional, reruns skip or resume the jobs done there
+
+	[[scenario]]
+	name = "corners"
+	topology = "grid"                # grid, torus, ring, star, smallworld or a load_topology file
+	size = [5, 7]
+	trusted = ["NoTN", "Central"]    # trusted_layouts names (grid and torus only) or lists of nodes
+	L = {start = 1, stop = 15, step = 2}
+	router = ["global", "local"]     # local is the smart local router, naive the naive one
+	seed = [1, 2, 3]
+
+Any of N, size, trusted, L (km of fiber per edge, or over the whole side with fixed_len), p
+(instead of L), q, d, Pz, router, protocol and seed may be a list or a {start, stop, step}
+range (stop included), and every combination is one job. precision, max_rounds, importance
+and stats_only are passed on to main(). Grids and tori default to the NoTN layout;
+other topologies use their own trusted nodes (a file's "trusted" line) unless given a list.
+Without a seed the run draws one (it is logged and kept in the checkpoint directory). Every
+job adds a row of main()'s stats and the scenario's parameters to its output.
+"""
+from __future__ import print_function
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+
+import simulator_clean as sim
+
+ALPHA = .15 # fiber loss in dB/km
+LAYOUT_TOPOLOGIES = ("grid", "torus")
+SWEPT = ["N", "size", "trusted", "L", "p", "q", "d", "Pz", "router", "protocol", "seed"]
+OPTIONS = ["precision", "max_rounds", "importance", "stats_only"]
+DEFAULTS = dict(N=10000, topology="grid", size=5, L=1, q=.85, d=.02, Pz=1/2, router="local", fixed_len=False)
+TOPOLOGIES = {
+	"torus": lambda n: sim.TorusGraph(n, n, ()),
+	"ring": lambda n: sim.RingGraph(n, ()),
+	"star": lambda n: sim.StarGraph(n, ()),
+	"smallworld": lambda n: sim.SmallWorldGraph(n, (), seed=0),
+}
+
+def load_batch(filename):
+	# the scenarios of a batch file, each with the file's top level defaults filled in
+	if filename.lower().endswith(".toml"):
+		try:
+			import tomllib
+		except ImportError:
+			# Python before 3.11
+			try:
+				import tomli as tomllib
+			except ImportError:
+				raise ImportError("Reading TOML batches needs Python 3.11 or tomli")
+		with open(filename, "rb") as f:
+			batch = tomllib.load(f)
+	else:
+		with open(filename) as f:
+			batch = json.load(f)
+	scenarios = batch.pop("scenario", [{}])
+	name = os.path.splitext(os.path.basename(filename))[0]
+	return [dict(list(DEFAULTS.items()) + [("name", "{}-{}".format(name, k))] + list(batch.items()) + list(s.items()))
+			for (k, s) in enumerate(scenarios)]
+
+def values(key, v):
+	# the values a swept parameter takes
+	if isinstance(v, dict):
+		(start, stop, step) = (v["start"], v["stop"], v.get("step", 1))
+		count = int(round((stop - start) / step)) + 1
+		return [start + k*step if isinstance(step, int) and isinstance(start, int) else round(start + k*step, 12) for k in range(count)]
+	if key == "trusted" and isinstance(v, list) and v and all([isinstance(t, int) for t in v]):
+		# a single list of nodes
+		return [v]
+	return v if isinstance(v, list) else [v]
+
+def build(scenario, point):
+	# main()'s positional args for one combination of a scenario's swept values
+	n = point["size"]
+	kind = scenario["topology"]
+	G = n if kind == "grid" else TOPOLOGIES[kind](n) if kind in TOPOLOGIES else sim.load_topology(kind)
+	nodes = range(n*n) if kind == "grid" else G.get_nodes()
+	T = point.get("trusted", "NoTN" if kind in LAYOUT_TOPOLOGIES else None)
+	if isinstance(T, str):
+		# layouts are node numbers of an n x n grid
+		if kind not in LAYOUT_TOPOLOGIES:
+			raise ValueError("trusted layout {!r} only applies to {} topologies, give {} a list of nodes".format(T, " and ".join(LAYOUT_TOPOLOGIES), kind))
+		T = sim.trusted_layouts(n)[sim.LAYOUT_NAMES.index(T)]
+	elif T is None:
+		T = G.get_trusted()
+		if len(T) < 2:
+			raise ValueError("the {} topology has no trusted nodes of its own, give it trusted = [...]".format(kind))
+	missing = sorted(set(T) - set(nodes))
+	if missing:
+		raise ValueError("trusted nodes {} are not in the {} topology".format(missing, kind))
+	p = point.get("p")
+	if p is None:
+		L = point["L"] / n if scenario["fixed_len"] else point["L"]
+		p = 10**-(ALPHA*L/10)
+	Pz = point["Pz"]
+	glob = point["router"] == "global"
+	return (point["N"], G, list(T), p, point["q"], point["d"], Pz, scenario.get("Px", 1 - Pz), glob, point["router"] == "naive")
+
+def expand(scenarios, checkpoint_dir = None):
+	# (scenario, point, job) for every combination, as run_job takes the jobs
+	jobs = []
+	seed = None
+	for scenario in scenarios:
+		swept = [k for k in SWEPT if k in scenario]
+		options = {k: scenario[k] for k in OPTIONS if k in scenario}
+		for combo in itertools.product(*[values(k, scenario[k]) for k in swept]):
+			point = dict(zip(swept, combo))
+			if point.get("seed") is None and seed is None:
+				seed = sim.sweep_seed(None, checkpoint_dir)
+			job_options = dict(options, protocol=point["protocol"]) if point.get("protocol") else options
+			key = (scenario["name"],) + tuple(sorted([(k, repr(v)) for (k, v) in point.items()]))
+			jobs.append((scenario, point, (build(scenario, point), point.get("seed", seed), sim.job_scenario(*key), checkpoint_dir, job_options)))
+	return jobs
+
+class CsvStore:
+	# ResultStore's interface over a single csv file, written when closed
+	def __init__(self, path):
+		self.path = path
+		self._rows = []
+
+	def append(self, row):
+		self._rows.append(dict(row))
+
+	def close(self):
+		columns = []
+		for row in self._rows:
+			columns.extend([k for k in row if k not in columns])
+		if os.path.dirname(self.path):
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		with open(self.path, "w", newline="") as f:
+			writer = csv.DictWriter(f, columns)
+			writer.writeheader()
+			writer.writerows(self._rows)
+
+def open_store(path):
+	return CsvStore(path) if path.lower().endswith(".csv") else sim.ResultStore(path)
+
+def main(files, workers = 1, dry_run = False, run = None):
+	# run, if given, takes the place of simulator_clean.run_jobs: run(jobs) gives run_job's results in order
+	scenarios = [s for filename in files for s in load_batch(filename)]
+	checkpoints = set([s.get("checkpoint") for s in scenarios])
+	if len(checkpoints) > 1:
+		raise ValueError("the scenarios of one run share one checkpoint directory, not {}".format(sorted(checkpoints, key=str)))
+	checkpoint_dir = checkpoints.pop()
+	if checkpoint_dir:
+		os.makedirs(checkpoint_dir, exist_ok=True)
+	jobs = expand(scenarios, checkpoint_dir)
+	if dry_run:
+		for (scenario, point, job) in jobs:
+			print(scenario["name"], json.dumps(point), "->", scenario.get("output", "-"))
+		return []
+	stores = {}
+	rows = []
+	try:
+		for s in scenarios:
+			if s.get("output") and s["output"] not in stores:
+				stores[s["output"]] = open_store(s["output"])
+		for ((scenario, point, job), (result, text, row)) in zip(jobs, (run or (lambda jobs: sim.run_jobs(jobs, workers)))([job for (s, p, job) in jobs])):
+			sim.log.info("%s %s", scenario["name"], json.dumps(point))
+			if text:
+				sim.log.info("       " + text.rstrip("\n"))
+			# scenario stays main()'s stream number, so (seed, scenario) replays the job; the row's L
+			# is the edge success probability, so the fiber length goes in km
+			row.update(scenario_name=scenario["name"], topology=scenario["topology"], trusted=json.dumps(job[0][2]), seed=job[1])
+			if "L" in point and "p" not in point:
+				row["km"] = point["L"]
+			rows.append(row)
+			if scenario.get("output"):
+				stores[scenario["output"]].append(row)
+	finally:
+		for store in stores.values():
+			store.close()
+	return rows
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Runs batches of simulator scenarios from JSON or TOML files.")
+	parser.add_argument("files", nargs="+", help="batch files (.json or .toml)")
+	parser.add_argument("--workers", type=int, default=1, help="worker processes (default 1)")
+	parser.add_argument("--dry-run", action="store_true", help="list the jobs without running them")
+	parser.add_argument("--log-level", default="INFO", help="simulator log level (default INFO)")
+	args = parser.parse_args()
+	sim.set_log_level(getattr(logging, args.log_level.upper()))
+	main(args.files, args.workers, args.dry_run)
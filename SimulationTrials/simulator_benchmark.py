@@ -0,0 +1,128 @@
+#!/bin/python3
+
+"""
+Times simulator_clean.main on fixed seed scenarios and compares the results to a saved baseline.
+Each scenario runs in a fresh process and reports rounds/s, peak RSS and the time spent in each
+stage (pair_ent, routing, path_ent, QKD, R2). Runs are deterministic, so the key bits and errors
+of every scenario must also match the baseline; a mismatch means the engine's results changed.
+
+	python simulator_benchmark.py [quick|scaling|full] [--save file.json] [--baseline file.json] [--tolerance .1] [--repeat 3]
+
+benchmarks/baseline-quick.json is the quick suite's baseline, saved with
+	python simulator_benchmark.py quick --save benchmarks/baseline-quick.json
+on the machine it names (python, platform, CPUs). Timings only compare on similar machines, so
+regenerate it the same way where the comparison runs, and after a deliberate change to the
+results; key bits and errors must match it anywhere.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+try:
+	import resource
+except ImportError:
+	# not on Windows; peak RSS is reported as 0 there
+	resource = None
+
+import simulator_clean as sim
+
+SEED = 2024
+# the parameters of simulator_clean's __main__ run: 1 km of fiber per edge
+P, Q, D = 10.**(-.15*1/10), .85, .02
+
+def trusted_nodes(n, k):
+	# k nodes evenly along the diagonal from corner to corner, so the quick suite's trusted links
+	# are 8 hops long and its runs end with a key
+	return [(n + 1) * round(i * (n - 1) / (k - 1)) for i in range(k)]
+
+def scenario(n, k, glob, N):
+	name = "grid{}-T{}-{}-N{}".format(n, k, "global" if glob else "local", N)
+	return name, dict(N=N, n=n, T=trusted_nodes(n, k), glob=glob)
+
+SUITES = {
+	# every grid size and router at a thousand rounds
+	"quick": [scenario(n, k, glob, 10**3) for (n, k) in [(5, 2), (9, 3), (13, 4), (17, 5), (21, 6)] for glob in (True, False)],
+	# rounds from 10^3 to 10^6 on a small grid and up to 10^5 on a large one
+	"scaling": [scenario(n, 2, glob, N) for (n, top) in [(5, 6), (13, 5)] for glob in (True, False) for N in [10**e for e in range(3, top + 1)]],
+}
+SUITES["full"] = SUITES["quick"] + [s for s in SUITES["scaling"] if s not in SUITES["quick"]]
+
+def peak_rss():
+	# peak resident set size of this process in MB (ru_maxrss is in kB on Linux, bytes on macOS)
+	if resource is None:
+		return 0.
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / 2.**20 if sys.platform == "darwin" else rss / 2.**10
+
+def run_scenario(spec):
+	tm = sim.Telemetry()
+	start = time.perf_counter()
+	(bits, errors) = sim.main(spec["N"], spec["n"], spec["T"], P, Q, D, glob=spec["glob"], seed=SEED, telemetry=tm)
+	elapsed = time.perf_counter() - start
+	return {
+		"seconds": elapsed,
+		"rounds_per_sec": spec["N"] / elapsed,
+		"peak_rss_mb": peak_rss(),
+		"stages": tm.metrics()["seconds"],
+		"bits": int(bits),
+		"errors": int(errors),
+	}
+
+def run_suite(specs, repeat = 3):
+	# keeps the fastest of repeat runs of each scenario
+	results = {}
+	for (name, spec) in specs:
+		for k in range(repeat):
+			# a new process per run so peak RSS is the scenario's own
+			with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+				r = pool.apply(run_scenario, (spec,))
+			if name not in results or r["seconds"] < results[name]["seconds"]:
+				results[name] = r
+		r = results[name]
+		print("{:<28} {:>10.1f} rounds/s {:>8.1f} MB   {}".format(name, r["rounds_per_sec"], r["peak_rss_mb"],
+				"  ".join(["{} {:.2f}s".format(stage, r["stages"][stage]) for stage in sim.Telemetry.STAGES])), flush=True)
+	return results
+
+def compare(results, baseline, tolerance):
+	# True if no scenario is slower than the baseline by more than tolerance or changed its results
+	ok = True
+	for name in results:
+		if name not in baseline:
+			continue
+		(r, b) = (results[name], baseline[name])
+		ratio = r["rounds_per_sec"] / b["rounds_per_sec"]
+		notes = []
+		if ratio < 1 - tolerance:
+			notes.append("SLOWER")
+		if (r["bits"], r["errors"]) != (b["bits"], b["errors"]):
+			notes.append("RESULTS CHANGED {} -> {}".format((b["bits"], b["errors"]), (r["bits"], r["errors"])))
+		ok = ok and not notes
+		print("{:<28} {:>6.2f}x  rss {:+8.1f} MB  {}".format(name, ratio, r["peak_rss_mb"] - b["peak_rss_mb"], " ".join(notes)))
+	return ok
+
+def main(suite = "quick", save = None, baseline = None, tolerance = .1, repeat = 3):
+	results = run_suite(SUITES[suite], repeat)
+	if save:
+		with open(save, "w") as f:
+			json.dump({"seed": SEED, "python": platform.python_version(), "machine": platform.machine(),
+					"platform": platform.platform(), "cpus": os.cpu_count(), "numpy": sim.np.__version__,
+					"scenarios": results}, f, indent=1, sort_keys=True)
+	if baseline:
+		with open(baseline) as f:
+			return compare(results, json.load(f)["scenarios"], tolerance)
+	return True
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmarks simulator_clean on fixed seed scenarios.")
+	parser.add_argument("suite", nargs="?", default="quick", choices=sorted(SUITES))
+	parser.add_argument("--save", help="write the results to this JSON file")
+	parser.add_argument("--baseline", help="compare against results saved earlier with --save")
+	parser.add_argument("--tolerance", type=float, default=.1, help="allowed drop in rounds/s (default .1)")
+	parser.add_argument("--repeat", type=int, default=3, help="runs per scenario, the fastest is kept (default 3)")
+	args = parser.parse_args()
+	sys.exit(0 if main(args.suite, args.save, args.baseline, args.tolerance, args.repeat) else 1)
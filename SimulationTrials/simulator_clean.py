@@ -5,20 +5,89 @@ Graph Rep:
 	N^2 = number of nodes (nodes {1-n^2})
 	Assume a square grid, so each node is connect0 to i-1, i+1, i+n
 	A set T |T| >=2 {1,n^2} Union {i} such that node i are trusted nodes
+	Other topologies (torus, ring, star, small world, any adjacency matrix or edge list)
+	are Topology objects and can be passed to main/generate_network in place of n.
 """
 from __future__ import print_function
-from ortools.graph import pywrapgraph
-import random
 import collections
 import sys
+import os
+import io
+import hashlib
+import importlib.util
+import json
+import logging
+import time
+import contextlib
+import concurrent.futures
 from copy import deepcopy
 from math import log2
 import math
-import networkx as nx
+import statistics
+import numpy as np
+
+# Everything the simulator reports goes through this logger, which is silent until configured
+# (set_log_level, or the logging module's own setup). main()'s summary is INFO, per pair and
+# graph detail is DEBUG.
+log = logging.getLogger("simulator")
+log.addHandler(logging.NullHandler())
+
+def set_log_level(level = logging.INFO, stream = None):
+	# shows the simulator's messages at level and above on stream (stdout by default)
+	log.setLevel(level)
+	if not [h for h in log.handlers if not isinstance(h, logging.NullHandler)]:
+		handler = logging.StreamHandler(stream or sys.stdout)
+		handler.setFormatter(logging.Formatter("%(message)s"))
+		log.addHandler(handler)
+
+class Telemetry:
+	"""
+	Time and call count per stage (pair_ent, routing, path_ent, QKD, R2) and named counters,
+	summed over every main() run it is passed to. progress(done, total), if given, is called
+	20 times a run; jsonl, if given, is a file name that gets one JSON line per run with its
+	parameters, results and metrics.
+	"""
+	STAGES = ("pair_ent", "routing", "path_ent", "QKD", "R2")
+
+	def __init__(self, progress = None, jsonl = None):
+		self.progress = progress
+		self.jsonl = jsonl
+		self.seconds = dict.fromkeys(self.STAGES, 0.0)
+		self.calls = dict.fromkeys(self.STAGES, 0)
+		self.counters = collections.Counter()
+
+	def add(self, stage, seconds, calls = 1):
+		self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+		self.calls[stage] = self.calls.get(stage, 0) + calls
+
+	def count(self, name, n = 1):
+		self.counters[name] += n
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		start = time.perf_counter()
+		yield
+		self.add(name, time.perf_counter() - start)
+
+	def metrics(self):
+		return {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+	def emit(self, record):
+		if self.jsonl:
+			with open(self.jsonl, "a") as f:
+				f.write(json.dumps(record, default=int) + "\n")
+
+def progress_bar(done, total):
+	# a Telemetry progress callback drawing main()'s old bar of 20 '|'
+	print("|", end="\n" if done >= total else "", flush=True)
 
 def shortest_path2(Gra,source, target):
+	import networkx as nx
 	G = nx.Graph()
-	for edge in Gra.get_edges():
+	# edges go in in the old Graph's set order, which decides how ties are broken
+	rank = Gra.set_rank()
+	for k in sorted(rank, key=rank.get):
+		edge = Gra.get_all_edges()[k]
 		G.add_edge(edge[0], edge[1])
 	try:
 		return nx.shortest_path(G,source, target)
@@ -27,18 +96,79 @@ def shortest_path2(Gra,source, target):
 	except nx.exception.NetworkXNoPath:
 		return ()
 
+def _unit_weight(u, v):
+	return 1
+
+def _bit_indices(live):
+	# indices of the set bits of a python int bitset, lowest first
+	return [k for k, b in enumerate(bin(live)[:1:-1]) if b == "1"]
+
 class Graph:
-	def __init__(self, nodes, edges, weight = lambda u,v: 1):
-		self._nodes = tuple([int(node) for node in nodes])
-		self._edges = set(edges)
+	# Nodes and edges are fixed when the graph is built and stored as a CSR adjacency
+	# (_indptr/_indices hold node positions, _edge_ids the matching edge index) plus an
+	# edge -> index map. Which edges are currently present is a bitset (a python int, bit k
+	# is _edge_list[k]), so graphs that only differ in live edges share everything else.
+	# _set_order is the edge indices in the order a python set of the edges, as they were
+	# given, iterates them: the order the old set based Graph handed edges to networkx.
+	__slots__ = ("_nodes", "_pos", "_edge_list", "_edge_index", "_indptr", "_indices", "_edge_ids", "_nbrs", "_live", "_weight", "_paths", "_routes",
+			"_set_order")
+
+	def __init__(self, nodes, edges, weight = _unit_weight):
 		self._weight = weight 
+		self._paths = None
+		self._routes = None
+		self._build(tuple([int(node) for node in nodes]), edges)
+		self._live = (1 << len(self._edge_list)) - 1
+
+	def _build(self, nodes, edges, live_edges = ()):
+		self._nodes = nodes
+		self._pos = {v: i for i, v in enumerate(nodes)}
+		given = [(int(min(e[0],e[1])), int(max(e[0],e[1]))) for e in edges if e[0] in self._pos and e[1] in self._pos]
+		self._edge_list = tuple(sorted(set(given)))
+		self._edge_index = {e: k for k, e in enumerate(self._edge_list)}
+		self._set_order = tuple([self._edge_index[e] for e in set(given)])
+		nbrs = [[] for v in nodes]
+		for k, (u,v) in enumerate(self._edge_list):
+			nbrs[self._pos[u]].append((v,k))
+			nbrs[self._pos[v]].append((u,k))
+		self._nbrs = tuple([tuple(sorted(x)) for x in nbrs])
+		self._indptr = np.cumsum([0] + [len(x) for x in self._nbrs])
+		self._indices = np.array([self._pos[v] for x in self._nbrs for (v,k) in x], dtype=np.int64)
+		self._edge_ids = np.array([k for x in self._nbrs for (v,k) in x], dtype=np.int64)
+		self._live = 0
+		for e in live_edges:
+			k = self._edge_index.get((min(e[0],e[1]), max(e[0],e[1])))
+			if k is not None:
+				self._live |= 1 << k
+
+	def live_copy(self, live = None):
+		# shallow copy sharing the adjacency arrays, with its own live edge bitset
+		G = object.__new__(type(self))
+		for cls in type(self).__mro__:
+			for slot in cls.__dict__.get("__slots__", ()):
+				setattr(G, slot, getattr(self, slot))
+		G._live = self._live if live is None else live
+		return G
 		
 	def print_graph(self):
 		print("Vertices: {}".format(self.get_nodes()))
 		print("Edges: {}".format([ (x, self.weight(x[0],x[1])) for x in self.get_edges()]))
 
 	def get_edges(self):
-		return self._edges
+		return set(self.get_edge_list())
+
+	def get_edge_list(self):
+		# live edges in edge index order
+		return [self._edge_list[k] for k in _bit_indices(self._live)]
+
+	def get_all_edges(self):
+		return self._edge_list
+
+	def get_live(self):
+		return self._live
+
+	def set_live(self, live):
+		self._live = live
 
 	def weight(self, u,v):
 		return self._weight(u,v)
@@ -48,47 +178,187 @@ class Graph:
 
 	def get_edge(self, u, v):
 		edge = (min(u,v), max(u,v))
-		if edge in self.get_edges():
+		k = self._edge_index.get(edge)
+		if k is not None and self._live >> k & 1:
 			return edge
 		return False
 
 	def set_edges(self, new_edges):
-		self._edges = set(new_edges)
+		new_edges = [(min(e[0],e[1]), max(e[0],e[1])) for e in new_edges]
+		if any([e not in self._edge_index for e in new_edges]):
+			self._build(self._nodes, self._edge_list + tuple(new_edges), new_edges)
+			return
+		live = 0
+		for e in new_edges:
+			live |= 1 << self._edge_index[e]
+		self._live = live
 
 	def set_nodes(self, new_nodes):
-		self._nodes = tuple(new_nodes)
+		# only the live edges between the new nodes are kept
+		live_edges = self.get_edge_list()
+		self._build(tuple(new_nodes), live_edges, live_edges)
 
 	def get_neighbors(self, u):
-		return set([v for v in self.get_nodes() if self.get_edge(u,v)])
+		i = self._pos.get(u)
+		if i is None:
+			return set()
+		live = self._live
+		return set([v for (v,k) in self._nbrs[i] if live >> k & 1])
 
 	def remove_edge(self, u, v):
-		e = self.get_edge(u,v)
-		if e:
-			self.get_edges().remove((e[0],e[1]))
+		k = self._edge_index.get((min(u,v), max(u,v)))
+		if k is not None:
+			self._live &= ~(1 << k)
 	def add_edge(self, u, v):
-		e = self.get_edge(u,v)
-		if not e:
-			self.get_edges().add((u,v))
-
-
-	def shortest_path(self, source, dest):
-		return shortest_path2(self,source,dest)
+		k = self._edge_index.get((min(u,v), max(u,v)))
+		if k is None:
+			self.set_edges(self.get_edge_list() + [(u,v)])
+		else:
+			self._live |= 1 << k
+
+	def _live_string(self):
+		# the bitset as a "0"/"1" string indexed by edge, cheaper to probe in loops than shifts
+		return bin(self._live | 1 << len(self._edge_list))[:2:-1]
+
+	def _has_live_edge(self, u):
+		i = self._pos.get(u)
+		return i is not None and any([self._live >> k & 1 for (v,k) in self._nbrs[i]])
+
+	def set_rank(self):
+		# {edge index: position} of the live edges in the order the old Graph iterated them: a
+		# python set built from the live edges in _set_order order, as pair_ent built a round's
+		# set. Removing edges never reorders a set, so a rank taken before edges go stays valid.
+		edges = self._edge_list
+		live = self._live_string()
+		order = set([edges[k] for k in self._set_order if live[k] == "1"])
+		index = self._edge_index
+		return {index[e]: r for (r, e) in enumerate(order)}
+
+	def shortest_path(self, source, dest, rank = None):
+		# Bidirectional BFS over the live edges, the same search nx.shortest_path runs in
+		# shortest_path2 on a networkx graph built from the old Graph's edge set. Each node's
+		# neighbors are visited in the order of its edges in that set (rank, from set_rank()
+		# by default), so equal length paths are tie-broken the way the old Graph did.
+		if not self._has_live_edge(source) or not self._has_live_edge(dest):
+			return ()
+		if source == dest:
+			return [source]
+		if rank is None:
+			rank = self.set_rank()
+		live = self._live_string()
+		nbrs = self._nbrs
+		pos = self._pos
+		order = lambda x: rank[x[1]]
+		pred = {source: None}
+		succ = {dest: None}
+		forward_fringe = [source]
+		reverse_fringe = [dest]
+		meet = None
+		while forward_fringe and reverse_fringe and meet is None:
+			if len(forward_fringe) <= len(reverse_fringe):
+				this_level, forward_fringe = forward_fringe, []
+				seen, other, fringe = pred, succ, forward_fringe
+			else:
+				this_level, reverse_fringe = reverse_fringe, []
+				seen, other, fringe = succ, pred, reverse_fringe
+			for u in this_level:
+				for (w,k) in sorted([x for x in nbrs[pos[u]] if live[x[1]] == "1"], key=order):
+					if w not in seen:
+						fringe.append(w)
+						seen[w] = u
+					if w in other:
+						meet = w
+						break
+				if meet is not None:
+					break
+		if meet is None:
+			return ()
+		path = []
+		w = meet
+		while w is not None:
+			path.append(w)
+			w = pred[w]
+		path.reverse()
+		w = succ[path[-1]]
+		while w is not None:
+			path.append(w)
+			w = succ[w]
+		return path
+
+	def bfs_distances(self, source, targets = ()):
+		# hop count from source to every node it can reach over live edges. With targets the
+		# search stops after the layer where the last target is found.
+		dist = {source: 0}
+		if source not in self._pos:
+			return dist
+		live = self._live_string()
+		nbrs = self._nbrs
+		pos = self._pos
+		left = set(targets) - set([source])
+		fringe = [source]
+		while fringe and (left or not targets):
+			next_fringe = []
+			for u in fringe:
+				for (w,k) in nbrs[pos[u]]:
+					if live[k] == "1" and w not in dist:
+						dist[w] = dist[u] + 1
+						next_fringe.append(w)
+						left.discard(w)
+			fringe = next_fringe
+		return dist
 	
 
+	def get_signature(self):
+		# (topology, dimension, edge set hash) of the live graph, the key for cached distance tables
+		digest = hashlib.sha1(np.array(self._nodes, dtype=np.int64).tobytes() + np.array(self.get_edge_list(), dtype=np.int64).tobytes()).hexdigest()
+		return ("graph", len(self._nodes), digest)
+
 	def all_paths(self):
-		paths = {}
-		for u in self.get_nodes():
-			for v in self.get_nodes():
-				path = self.shortest_path(u,v)
-				if u in paths:
-					paths[u][v] = len(path) -1 #(len(path)-1, path)
-				else:
-					paths[u] = {v:len(path) -1} #(len(path)-1, path)}
-		self._paths = paths
-		return paths
+		self._paths = distance_table(self)[1]
+		self._routes = _routing_cache.setdefault(self.get_signature(), {})
+		return self._paths
+
+class Topology(Graph):
+	"""
+	A network: nodes, edges with their length in fiber segments (a Bell pair over an edge of
+	w segments succeeds with probability p**w) and the trusted nodes. axis(u, v) names the
+	direction of an edge for the local router, which tries to keep a path going the same
+	way; topologies without directions give every edge the same one.
+	"""
+	__slots__ = ("trusted", "_name", "_segments")
+
+	def __init__(self, nodes, edges, T, name = "graph"):
+		# edges are (u, v) or (u, v, fiber segments); self loops are dropped
+		self._segments = {(min(e[0],e[1]), max(e[0],e[1])): e[2] for e in edges if len(e) > 2 and e[2] != 1}
+		self.trusted = tuple(sorted([int(t) for t in T]))
+		self._name = name
+		super().__init__(nodes, [e[:2] for e in edges if e[0] != e[1]])
+
+	def weight(self, u, v):
+		return self._segments.get((min(u,v), max(u,v)), 1)
+
+	def axis(self, u, v):
+		return 0
+
+	def get_name(self):
+		return "{} node {}".format(len(self._nodes), self._name.title())
+
+	def get_signature(self):
+		return (self._name, len(self._nodes), super().get_signature()[2])
+
+	def get_trusted(self):
+		return self.trusted
+
+	def show_graph(self):
+		print("")
+		print("{}, trusted nodes {}".format(self.get_name(), list(self.trusted)))
+		for (u, v) in self.get_edge_list():
+			print("{}{} -- {}{}".format(u, "T" if u in self.trusted else "", v, "T" if v in self.trusted else ""))
+
+class GridGraph(Topology):
+	__slots__ = ("_n",)
 
-class GridGraph(Graph):
-	def __init__(self, n, T, weight=lambda u,v: 1):
+	def __init__(self, n, T):
 		self._n = n
 		vert = tuple([i for i in range(0,n*n)])
 		edgel = []
@@ -97,8 +367,13 @@ class GridGraph(Graph):
 				edgel.append((i, i+1))
 			if i+n in vert:
 				edgel.append((i, i+n))
-		self.trusted = tuple(sorted([int(t) for t in T]))
-		super().__init__(vert, edgel)
+		super().__init__(vert, edgel, T, "grid")
+
+	def axis(self, u, v):
+		return abs(u-v)
+
+	def get_name(self):
+		return "{}x{} Grid".format(self._n, self._n)
 
 	def show_graph(self):
 		print("")
@@ -126,25 +401,464 @@ class GridGraph(Graph):
 
 	def get_dim(self):
 		return self._n
-	def get_trusted(self):
-		return self.trusted
 
-def generate_network(n,T, p, q, d):
-	G = GridGraph(n,T)
-	P = {i:{j: p for j in range(0,n**2) if G.get_edge(i,j)} for i in range(0,n**2)}
-	D = {i:{j: d for j in range(0,n**2) if G.get_edge(i,j)} for i in range(0,n**2)}
-	Q = [q for i in range(n**2)]
+class TorusGraph(Topology):
+	# rows x cols grid whose rows and columns wrap around (TorusTopology.m)
+	__slots__ = ("_cols",)
+
+	def __init__(self, rows, cols, T):
+		self._cols = cols
+		edges = []
+		for node in range(rows*cols):
+			(r, c) = divmod(node, cols)
+			edges.append((node, r*cols + (c+1) % cols))
+			edges.append((node, ((r+1) % rows)*cols + c))
+		super().__init__(range(rows*cols), edges, T, "torus")
+
+	def axis(self, u, v):
+		return 1 if u // self._cols == v // self._cols else self._cols
+
+	def get_name(self):
+		return "{}x{} Torus".format(len(self._nodes) // self._cols, self._cols)
+
+class RingGraph(Topology):
+	# n nodes in a cycle (RingTopology.m)
+	__slots__ = ()
+
+	def __init__(self, n, T):
+		super().__init__(range(n), [(i, (i+1) % n) for i in range(n)], T, "ring")
+
+class StarGraph(Topology):
+	# n-1 nodes all linked to the last node, the hub (StarTopology.m)
+	__slots__ = ()
+
+	def __init__(self, n, T):
+		super().__init__(range(n), [(i, n-1) for i in range(n-1)], T, "star")
+
+class SmallWorldGraph(GridGraph):
+	"""
+	n x n grid where, as in SmallWorldTopology.m, every untrusted node in turn swaps a link to
+	a random untrusted neighbor for a link to a random node in the same row (horizontal
+	link) or column (vertical link). A new link is as long as the straight line it replaces,
+	so it spans as many fiber segments as the nodes are apart. seed fixes the rewiring.
+	"""
+	__slots__ = ()
+
+	def __init__(self, n, T, seed = None):
+		grid = GridGraph(n, T)
+		prng = np.random.default_rng(seed)
+		adj = {v: dict([(u, 1) for u in grid.get_neighbors(v)]) for v in grid.get_nodes()}
+		for node in grid.get_nodes():
+			if node in grid.trusted:
+				continue
+			neighbors = sorted([u for u in adj[node] if u not in grid.trusted])
+			if not neighbors:
+				continue
+			old = neighbors[prng.integers(len(neighbors))]
+			if node % n == old % n:
+				poss = [u for u in range(node % n, n*n, n) if u != node]
+			else:
+				poss = [u for u in range(node - node % n, node - node % n + n) if u != node]
+			new = poss[prng.integers(len(poss))]
+			if new in adj[node]:
+				continue
+			del adj[node][old], adj[old][node]
+			adj[node][new] = adj[new][node] = abs(node - new) // (n if node % n == new % n else 1)
+		self._n = n
+		Topology.__init__(self, grid.get_nodes(), [(u, v, w) for u in adj for (v, w) in adj[u].items() if u < v], T, "small world")
+
+	def axis(self, u, v):
+		return 1 if u // self._n == v // self._n else self._n
+
+	def get_name(self):
+		return "{}x{} Small World".format(self._n, self._n)
+
+	def show_graph(self):
+		Topology.show_graph(self)
+
+def adjacency_topology(A, T, name = "graph"):
+	# Topology from an adjacency matrix whose entries are fiber segments (0 for no edge)
+	A = np.asarray(A)
+	edges = [(int(u), int(v), A[u, v].item()) for (u, v) in zip(*np.nonzero(A)) if u < v]
+	return Topology(range(len(A)), edges, T, name)
+
+def load_topology(filename, T = None, name = None):
+	"""
+	Reads a topology from an edge list (lines of "u v" or "u v segments", '#' comments, an
+	optional "trusted u v ..." line), a .npy/.npz adjacency matrix or a .mat file holding an
+	adjacency matrix (AdjacencyMatrix or A) and optionally TrustedNodes (or T). Node numbers
+	in .mat files are MATLAB's, so they are shifted to start at 0. T overrides the trusted
+	nodes found in the file.
+	"""
+	name = name or os.path.splitext(os.path.basename(filename))[0]
+	ext = os.path.splitext(filename)[1].lower()
+	trusted = None
+	if ext == ".mat":
+		try:
+			import scipy.io
+		except ImportError:
+			raise ImportError("Reading .mat topologies needs scipy")
+		data = scipy.io.loadmat(filename)
+		A = data.get("AdjacencyMatrix", data.get("A"))
+		if A is None:
+			raise ValueError("{} has no AdjacencyMatrix. Topology objects saved by MATLAB can't be read "
+					"outside it, save the matrix itself: A = t.AdjacencyMatrix; T = t.TrustedNodes; save(file, 'A', 'T')".format(filename))
+		if data.get("TrustedNodes", data.get("T")) is not None:
+			trusted = [int(t) - 1 for t in np.ravel(data.get("TrustedNodes", data.get("T")))]
+		G = adjacency_topology(A, (), name)
+	elif ext in (".npy", ".npz"):
+		data = np.load(filename)
+		if ext == ".npz":
+			trusted = data["T"].tolist() if "T" in data else None
+			data = data["A"]
+		G = adjacency_topology(data, (), name)
+	else:
+		edges, nodes = [], set()
+		with open(filename) as f:
+			for line in f:
+				fields = line.split("#")[0].split()
+				if not fields:
+					continue
+				if fields[0] == "trusted":
+					trusted = [int(t) for t in fields[1:]]
+					continue
+				(u, v) = (int(fields[0]), int(fields[1]))
+				edges.append((u, v, float(fields[2])) if len(fields) > 2 else (u, v))
+				nodes.update((u, v))
+		G = Topology(sorted(nodes), edges, (), name)
+	G.trusted = tuple(sorted([int(t) for t in (T if T is not None else trusted or ())]))
+	return G
+
+# Hop counts between every pair of nodes, keyed by Graph.get_signature(). Each entry is the
+# (V x V) int32 table (-1 where there is no path) and the same numbers as {u: {v: hops}},
+# which is the form the routers read through G._paths. Both are shared, so treat them as
+# read only. Set DISTANCE_CACHE_DIR to also keep the tables as .npy files between runs.
+DISTANCE_CACHE_DIR = None
+_distance_cache = {}
+# local_R1 decision tables, keyed like _distance_cache and reached through G._routes
+_routing_cache = {}
+
+def distance_table(G):
+	key = G.get_signature()
+	if key in _distance_cache:
+		return _distance_cache[key]
+	nodes = G.get_nodes()
+	filename = os.path.join(DISTANCE_CACHE_DIR, "{}-{}-{}.npy".format(*key)) if DISTANCE_CACHE_DIR else None
+	if filename and os.path.exists(filename):
+		table = np.load(filename)
+	else:
+		table = np.full((len(nodes), len(nodes)), -1, dtype=np.int32)
+		pos = {v: i for i, v in enumerate(nodes)}
+		for i, u in enumerate(nodes):
+			if not G.get_neighbors(u):
+				continue # shortest_path treats nodes without edges as missing, even to themselves
+			for v, hops in G.bfs_distances(u).items():
+				table[i, pos[v]] = hops
+		if filename:
+			os.makedirs(DISTANCE_CACHE_DIR, exist_ok=True)
+			np.save(filename, table)
+	table.setflags(write=False)
+	rows = table.tolist()
+	paths = {u: dict(zip(nodes, rows[i])) for i, u in enumerate(nodes)}
+	_distance_cache[key] = (table, paths)
+	return _distance_cache[key]
+
+def fail_nodes(G, failed):
+	"""
+	G without the edges of the failed nodes. Its distance table is derived from G's: a source
+	keeps its row unless a failed node lies on one of its shortest paths (or it lost all of
+	its edges), so only those rows are searched again. Samples that fail the same nodes get
+	the same signature and share the table through _distance_cache.
+	"""
+	live = G.get_live()
+	for v in failed:
+		for (u,k) in G._nbrs[G._pos[v]]:
+			live &= ~(1 << k)
+	Gf = G.live_copy(live)
+	key = Gf.get_signature()
+	if key in _distance_cache:
+		return Gf
+	nodes = G.get_nodes()
+	table = distance_table(G)[0]
+	hops = table.astype(np.int64)
+	reachable = hops >= 0
+	pos = [G._pos[v] for v in failed]
+	stale = np.zeros(len(nodes), dtype=bool)
+	stale[pos] = True
+	for f in pos:
+		through = reachable[:, f, None] & reachable[None, f, :] & (hops[:, f, None] + hops[None, f, :] == hops)
+		through[:, f] = False
+		stale |= through.any(axis=1)
+	stale |= np.array([G._has_live_edge(v) and not Gf._has_live_edge(v) for v in nodes], dtype=bool)
+	new = table.copy()
+	new[:, pos] = -1
+	for i in np.flatnonzero(stale):
+		new[i] = -1
+		if Gf.get_neighbors(nodes[i]):
+			for v, h in Gf.bfs_distances(nodes[i]).items():
+				new[i, G._pos[v]] = h
+	new.setflags(write=False)
+	rows = new.tolist()
+	_distance_cache[key] = (new, {u: dict(zip(nodes, rows[i])) for i, u in enumerate(nodes)})
+	return Gf
+
+class Stream:
+	# Uniform draws for one purpose (routing, path_ent, QKD, ...) in one round. The round's block
+	# is prefetched by RoundStreams; should a round need more, it continues on a Philox stream of
+	# its own whose counter (second word = round+1) no other round or block uses.
+	__slots__ = ("_buf", "_next", "_key", "_round", "_more")
+
+	def __init__(self, buf, key, r):
+		self._buf = buf
+		self._next = 0
+		self._key = key
+		self._round = r
+		self._more = None
+
+	def random(self):
+		if self._next == len(self._buf):
+			if self._more is None:
+				self._more = np.random.Generator(np.random.Philox(key=self._key, counter=np.array([0, self._round+1, 0, 0], dtype=np.uint64)))
+			self._buf = self._more.random(RoundStreams.BLOCK).tolist()
+			self._next = 0
+		x = self._buf[self._next]
+		self._next += 1
+		return x
+
+	def choice(self, seq):
+		return seq[min(int(self.random()*len(seq)), len(seq)-1)]
+
+	def seed(self):
+		# 53 random bits, for seeding a numpy generator
+		return int(self.random()*9007199254740992.0)
+
+class RoundRNG:
+	# Everything random in one round: a uniform draw per edge index for pair_ent and the
+	# routing (ran), path_ent (ent) and attempt_QKD (qkd) streams.
+	__slots__ = ("round", "edges", "ran", "ent", "qkd")
+
+	def __init__(self, r, edges, ran, ent, qkd):
+		self.round = r
+		self.edges = edges
+		self.ran = ran
+		self.ent = ent
+		self.qkd = qkd
+
+class RoundStreams:
+	"""
+	Counter based random streams for one scenario. Each purpose gets a Philox key from
+	SeedSequence(seed, spawn_key=(scenario,)), and round r reads the counter block r of that
+	key, so what a round draws depends only on (seed, scenario, round). Rounds can be replayed
+	one at a time or split over any number of workers without changing the results.
+	"""
+	BLOCK = 64 # draws per round prefetched for each of ran, ent and qkd
+
+	def __init__(self, seed, scenario = 0):
+		self.seed = seed
+		self.scenario = scenario
+		children = np.random.SeedSequence(seed, spawn_key=(scenario,)).spawn(6)
+		(self._gen, self._ran, self._ent, self._qkd, self._r2, self._link) = [c.generate_state(2, np.uint64) for c in children]
+
+	def _block(self, key, r0, rounds, stride):
+		# stride is a multiple of 4, the number of draws Philox makes per counter step
+		bitgen = np.random.Philox(key=key, counter=np.array([r0*stride//4, 0, 0, 0], dtype=np.uint64))
+		return np.random.Generator(bitgen).random(rounds*stride).reshape(rounds, stride)
+
+	def edge_draws(self, r0, rounds, edges):
+		# (rounds x edges) uniform draws for pair_ent, row i belonging to round r0+i
+		return self._block(self._gen, r0, rounds, 4*((edges+3)//4) or 4)[:, :edges]
+
+	def rounds(self, r0, rounds, edges):
+		draws = self.edge_draws(r0, rounds, edges)
+		(ran, ent, qkd) = [self._block(key, r0, rounds, self.BLOCK).tolist() for key in (self._ran, self._ent, self._qkd)]
+		return [RoundRNG(r0+i, draws[i], Stream(ran[i], self._ran, r0+i), Stream(ent[i], self._ent, r0+i), Stream(qkd[i], self._qkd, r0+i))
+				for i in range(rounds)]
+
+	def round(self, r, edges):
+		return self.rounds(r, 1, edges)[0]
+
+	def link_draws(self, r0, rounds, links):
+		# (rounds x links x 4) uniform draws for ImportanceSampler, row i belonging to round r0+i
+		return self._block(self._link, r0, rounds, 4*links or 4).reshape(rounds, -1, 4)[:, :links]
+
+	def distill(self):
+		# stream for R2_regular, which runs once after all rounds
+		return Stream([], self._r2, 0)
+
+_POPCOUNT = np.array([bin(b).count("1") for b in range(256)], dtype=np.uint8)
+
+class KeyPool:
+	# Raw key bits shared by a pair of trusted nodes, packed 8 to a byte (bit i of the pool is
+	# bit i%8 of byte i//8, little endian). Bits are appended at _end and consumed from _start,
+	# which is how R2_regular spends them when relaying.
+	__slots__ = ("_buf", "_start", "_end")
+
+	def __init__(self, bits = ()):
+		self._buf = np.zeros(16, dtype=np.uint8)
+		self._start = 0
+		self._end = 0
+		self.extend(bits)
+
+	def __len__(self):
+		return self._end - self._start
+
+	def __str__(self):
+		return "".join([str(b) for b in self.bits()])
+
+	def _reserve(self, n):
+		# drop consumed bytes, then double the buffer until n more bits fit
+		drop = self._start >> 3
+		if drop:
+			self._buf = self._buf[drop:].copy()
+			self._start -= drop*8
+			self._end -= drop*8
+		size = len(self._buf)
+		while size*8 < self._end + n:
+			size *= 2
+		if size != len(self._buf):
+			buf = np.zeros(size, dtype=np.uint8)
+			buf[:len(self._buf)] = self._buf
+			self._buf = buf
+
+	def append(self, bit):
+		if self._end >= len(self._buf)*8:
+			self._reserve(1)
+		if bit:
+			self._buf[self._end >> 3] |= 1 << (self._end & 7)
+		self._end += 1
+
+	def extend(self, bits):
+		bits = np.asarray(bits, dtype=np.uint8)
+		if not len(bits):
+			return
+		self._reserve(len(bits))
+		offset = self._end & 7
+		first = self._end >> 3
+		# pad the front so the new bits line up with the partly filled last byte
+		packed = np.packbits(np.concatenate([np.zeros(offset, dtype=np.uint8), bits]), bitorder="little")
+		self._buf[first:first+len(packed)] |= packed
+		self._end += len(bits)
+
+	def bits(self, n = None):
+		# the first n unconsumed bits (all of them by default) as a 0/1 uint8 array
+		n = len(self) if n is None else n
+		if n > len(self):
+			raise IndexError("key pool has {} bits, {} requested".format(len(self), n))
+		first = self._start >> 3
+		offset = self._start & 7
+		window = self._buf[first:(self._start + n + 7 >> 3) + 1]
+		return np.unpackbits(window, bitorder="little")[offset:offset+n]
+
+	def take(self, n):
+		# consume the first n bits
+		taken = self.bits(n)
+		self._start += n
+		return taken
+
+	def count_ones(self):
+		if self._start == self._end:
+			return 0
+		first, last = self._start >> 3, (self._end - 1) >> 3
+		window = self._buf[first:last+1].copy()
+		window[0] &= (0xFF << (self._start & 7)) & 0xFF
+		window[-1] &= 0xFF >> (7 - ((self._end - 1) & 7))
+		return int(_POPCOUNT[window].sum(dtype=np.int64))
+
+	def reset(self, n = 0):
+		# replace the contents with n zero bits
+		self._buf = np.zeros(max(16, (n >> 3) + 1), dtype=np.uint8)
+		self._start = 0
+		self._end = n
+
+class CountPool:
+	# Statistics only stand-in for KeyPool: keeps how many bits the pool holds and how many of
+	# them are errors, never the bits themselves, so memory does not grow with the run length.
+	# take() hands back the number of errors among the bits it consumes. That is exact whenever
+	# the pool is all errors or error free (which covers R2_regular, since privacy amplification
+	# leaves every pool all zeros before relaying); otherwise it is drawn from the hypergeometric
+	# distribution the bit version would give for randomly placed errors.
+	__slots__ = ("_len", "_ones")
+
+	def __init__(self, bits = ()):
+		self._len = 0
+		self._ones = 0
+		self.extend(bits)
+
+	def __len__(self):
+		return self._len
+
+	def __str__(self):
+		return "<{} bits, {} errors>".format(self._len, self._ones)
+
+	def append(self, bit):
+		self._len += 1
+		self._ones += 1 if bit else 0
+
+	def extend(self, bits):
+		bits = np.asarray(bits, dtype=np.uint8)
+		self.add_counts(len(bits), int(np.count_nonzero(bits)))
+
+	def add_counts(self, n, ones):
+		self._len += n
+		self._ones += ones
+
+	def take(self, n, rng):
+		if n > self._len:
+			raise IndexError("key pool has {} bits, {} requested".format(self._len, n))
+		ones = _split_errors(self._ones, self._len - self._ones, n, rng)
+		self._len -= n
+		self._ones -= ones
+		return ones
+
+	def count_ones(self):
+		return self._ones
+
+	def reset(self, n = 0):
+		self._len = n
+		self._ones = 0
+
+def _split_errors(ones, zeros, n, rng):
+	# errors among n bits drawn without replacement from ones errors and zeros good bits
+	if ones == 0 or n == 0:
+		return 0
+	if zeros == 0 or n == ones + zeros:
+		return min(ones, n)
+	return int(np.random.default_rng(rng.seed()).hypergeometric(ones, zeros, n))
+
+def generate_network(n,T, p, q, d, pool = KeyPool):
+	# n is the grid size or a Topology; T, if given, replaces the topology's trusted nodes
+	if isinstance(n, Topology):
+		G = n.live_copy()
+		if T is not None:
+			G.trusted = tuple(sorted([int(t) for t in T]))
+	else:
+		G = GridGraph(n,T)
+	P = {i:{} for i in G.get_nodes()}
+	D = {i:{} for i in G.get_nodes()}
+	for (i,j) in G.get_edge_list():
+		P[i][j] = P[j][i] = p ** G.weight(i,j)
+		D[i][j] = D[j][i] = d
+	Q = {i: q for i in G.get_nodes()}
 	K = {i:{j: 0 for j in G.get_trusted()} for i in G.get_trusted()}
-	Kb = {i:{j: "" for j in G.get_trusted()} for i in G.get_trusted()}
+	Kb = {i:{j: pool() for j in G.get_trusted()} for i in G.get_trusted()}
 
 	return (G,P,Q,D,K, Kb)
 
-def pair_ent(G, P):
-	G1 = GridGraph(G.get_dim(), G.get_trusted()) 
-	G1.set_edges([e for e in G.get_edges() if PRNG_gen.random() < P[e[0]][e[1]]])
-	return G1
+def edge_probabilities(G, P):
+	# success probability per edge index, 0 for edges missing from G so they never come up
+	edges = G.get_all_edges()
+	probs = np.zeros(len(edges))
+	for k in _bit_indices(G.get_live()):
+		probs[k] = P[edges[k][0]][edges[k][1]]
+	return probs
 
-def R1_find_best_links(G,G1,K,node, naive = False):
+def pair_ent(G, P, rng):
+	return G.live_copy(mask_to_live(rng.edges < edge_probabilities(G, P)))
+
+def mask_to_live(mask):
+	return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+def R1_find_best_links(G,G1,K,node, naive, rng):
 
 	neighbors = G1.get_neighbors(node) #these nodes are connected by ent channel to our noe
 	trusted = G1.get_trusted()
@@ -161,7 +875,7 @@ def R1_find_best_links(G,G1,K,node, naive = False):
 	
 	Poss1 = [p for p in neigh_trusted1 if dist(p) == best_dist_1]
 	#print(Poss1)
-	(v1,t1) = PRNG_gen.choice(Poss1)
+	(v1,t1) = rng.ran.choice(Poss1)
 
 	neigh_trusted2 = [(u,T) for u in neighbors for T in trusted if T!=t1] # TODO: Does this line mean you can get the same neighbor twice?
 	best_dist_2 = dist(min(neigh_trusted2, key=dist)) #this gives us the best distance
@@ -170,11 +884,11 @@ def R1_find_best_links(G,G1,K,node, naive = False):
 
 	Poss2a = [p for p in neigh_trusted2 if dist(p) == best_dist_2 ]
 
-	Poss2 = [p for p in Poss2a if abs(node-p[0]) == abs(node-v1)]
+	Poss2 = [p for p in Poss2a if G.axis(node,p[0]) == G.axis(node,v1)]
 	if naive or not Poss2 : #if naive flag is set dont try and maintain direction
 		Poss2 = Poss2a
 	#print(Poss2)
-	(v2,t2) = PRNG_gen.choice(Poss2)
+	(v2,t2) = rng.ran.choice(Poss2)
 	
 
 	if v1 == v2:
@@ -188,8 +902,8 @@ def R1_find_best_links(G,G1,K,node, naive = False):
 		next_best_2 = dist(min(next_nt2, key=dist))
 		next_poss1 = [p for p in next_nt1 if dist(p) == next_best_1]
 		next_poss2 = [p for p in next_nt2 if dist(p) == next_best_2]
-		(nv1, nt1) = PRNG_gen.choice(next_poss1)
-		(nv2, nt2) = PRNG_gen.choice(next_poss1)
+		(nv1, nt1) = rng.ran.choice(next_poss1)
+		(nv2, nt2) = rng.ran.choice(next_poss1)
 
 
 		if dist((v1,t1)) + dist((nv2, nt2)) < dist((nv1,nt1)) + dist((v2,t2)):
@@ -197,29 +911,22 @@ def R1_find_best_links(G,G1,K,node, naive = False):
 		elif dist((v1,t1)) + dist((nv2, nt2)) >dist((nv1,nt1)) + dist((v2,t2)):
 			v1,t1 = nv1,nt1
 		else:
-			which = PRNG_gen.choice([0,1])
+			which = rng.ran.choice([0,1])
 			if which:
 				v1,t1 = nv1,nt1
 			else:
 				v2,t2 = nv2,nt2
 
 		if v1 == v2:
-			print("Error!")
-			print("G")
-			G.show_graph()
-			print("G1")
-			G1.show_graph()
-			print("Paths:", G._paths)
-			print("node", node)
-			print("Poss1: ", Poss1)
-			print("Poss2: ", Poss2)
-			print("V1, t1, v2, t2: ", v1,t1,v2,t2)
-
-			print("Could we do:")
-			print("V1, t1, v2, t2: ", v1,t1,nv2,nt2)
-			print("or:")
-			print("V1, t1, v2, t2: ", nv1,nt1,v2,t2)
-			print(dist((v1,t1)) + dist((nv2, nt2)), dist((nv1,nt1)) + dist((v2,t2)))
+			buf = io.StringIO()
+			with contextlib.redirect_stdout(buf):
+				print("G")
+				G.show_graph()
+				print("G1")
+				G1.show_graph()
+			log.error("Error!\n%s\nPaths: %s\nnode %s\nPoss1: %s\nPoss2: %s\nV1, t1, v2, t2: %s\nCould we do: %s\nor: %s\n%s %s",
+					buf.getvalue(), G._paths, node, Poss1, Poss2, (v1,t1,v2,t2), (v1,t1,nv2,nt2), (nv1,nt1,v2,t2),
+					dist((v1,t1)) + dist((nv2, nt2)), dist((nv1,nt1)) + dist((v2,t2)))
 			raise RuntimeError("Error, trying to link same node to itself")
 	#print(v1,t1, v2,t2)
 	Pt.append([min(v1,v2), node, max(v1,v2)])
@@ -237,128 +944,215 @@ def R1_find_best_links(G,G1,K,node, naive = False):
 
 	return Pt
 
-def local_R1(G, G1, K, naive = False): 
+def local_routing_table(G, naive):
+	"""
+	{(node, mask): tree} of what R1_find_best_links does at node when the neighbors in mask
+	(bit j for the j-th neighbor of node in G) have Bell pairs with it. A tuple in the tree is
+	a random choice, taken as rng.ran.choice(tree) just as R1_find_best_links draws it, and a
+	list is the resulting swaps. Trees only depend on G's distances, so the first round to
+	see a (node, mask) builds it and every later round only walks it.
+	"""
+	return G._routes.setdefault((tuple(G.get_trusted()), naive), {})
+
+# Nodes with more neighbors than this (a star's hub) see too many masks to table, so
+# local_R1 runs R1_find_best_links on them directly
+LOCAL_TABLE_DEGREE = 8
+
+def neighbor_masks(G, G1):
+	# the mask of live neighbors of every node of G in G1, in node order, -1 for nodes
+	# with more than LOCAL_TABLE_DEGREE neighbors
+	live = np.frombuffer(G1._live_string().encode(), dtype=np.uint8)[G._edge_ids] == ord("1")
+	degree = np.diff(G._indptr)
+	slot = np.arange(len(G._edge_ids)) - np.repeat(G._indptr[:-1], degree)
+	masks = np.zeros(len(degree), dtype=np.int64)
+	np.add.at(masks, np.repeat(np.arange(len(degree)), degree), live << np.minimum(slot, LOCAL_TABLE_DEGREE))
+	masks[degree > LOCAL_TABLE_DEGREE] = -1
+	return masks.tolist()
+
+def _local_decisions(G, node, mask, naive):
+	# the same steps as R1_find_best_links, with every choice expanded instead of drawn
+	neighbors = set([v for (j,(v,k)) in enumerate(G._nbrs[G._pos[node]]) if mask >> j & 1])
+	trusted = G.get_trusted()
+	dist = lambda x: G._paths[x[0]][x[1]]
+	if len(neighbors) <= 1:
+		return []
+	neigh_trusted1 = [(u,T) for u in neighbors for T in trusted]
+	best_dist_1 = dist(min(neigh_trusted1, key=dist))
+	Poss1 = [p for p in neigh_trusted1 if dist(p) == best_dist_1]
+
+	def links(v1, v2):
+		if v1 == v2:
+			raise RuntimeError("Error, trying to link same node to itself")
+		Pt = [[min(v1,v2), node, max(v1,v2)]]
+		rest = neighbors - set([v1, v2])
+		if len(rest) == 2:
+			Pt.append([min(rest), node, max(rest)])
+		return Pt
+
+	def second(v1, t1):
+		neigh_trusted2 = [(u,T) for u in neighbors for T in trusted if T!=t1]
+		best_dist_2 = dist(min(neigh_trusted2, key=dist))
+		Poss2a = [p for p in neigh_trusted2 if dist(p) == best_dist_2 ]
+		Poss2 = [p for p in Poss2a if G.axis(node,p[0]) == G.axis(node,v1)]
+		if naive or not Poss2 :
+			Poss2 = Poss2a
+		return tuple([clash(v1, t1, v2, t2) for (v2,t2) in Poss2])
+
+	def clash(v1, t1, v2, t2):
+		if v1 != v2:
+			return links(v1, v2)
+		next_nt1 = [p for p in neigh_trusted1 if p[0] != v1 and p[1] != t2]
+		next_nt2 = [(u,T) for u in neighbors for T in trusted if T!=t1 and u != v2]
+		next_best_1 = dist(min(next_nt1, key=dist))
+		dist(min(next_nt2, key=dist)) # unused, but fails where R1_find_best_links fails
+		next_poss1 = [p for p in next_nt1 if dist(p) == next_best_1]
+		# R1_find_best_links draws both replacements from next_poss1
+		return tuple([tuple([settle(v1, t1, v2, t2, n1, n2) for n2 in next_poss1]) for n1 in next_poss1])
+
+	def settle(v1, t1, v2, t2, n1, n2):
+		(nv1, nt1), (nv2, nt2) = n1, n2
+		if dist((v1,t1)) + dist((nv2, nt2)) < dist((nv1,nt1)) + dist((v2,t2)):
+			return links(v1, nv2)
+		elif dist((v1,t1)) + dist((nv2, nt2)) > dist((nv1,nt1)) + dist((v2,t2)):
+			return links(nv1, v2)
+		return (links(v1, nv2), links(nv1, v2))
+
+	return tuple([second(v1, t1) for (v1,t1) in Poss1])
+
+def local_R1(G, G1, K, naive, rng): 
 	#G1.show_graph()
 	trusted = G1.get_trusted()
+	table = local_routing_table(G, naive)
+	masks = neighbor_masks(G, G1)
 	Pt = []
-	for node in G1.get_nodes():
-		if node not in trusted:
-			result = R1_find_best_links(G,G1,K,node, naive)
-			#print("best links for ", node, result)
-			#print(result)
-			if result:
-				#print("Result," ,result)
-				#print("Path", Pt)
-				for add in result:
-					added = False
-					#print("new", add)
-					for path in Pt:
-						#print(" add, path", add[:-1], path[-2:])
-						# [2, 3, /4] == path[/1, 2, 3]
-						if add[:-1] == path[-2:]:
-							path.append(add[-1])
-							added = True
-							#print("mrg-",Pt)
-					if not added:
-						Pt.append(add)
-
-
-	#print(Pt)
-	#raise RuntimeError
-	ret = [p for p in Pt if p[0 ] in trusted and p[-1] in trusted]
+	for (node, mask) in zip(G.get_nodes(), masks):
+		if mask and node not in trusted:
+			result = table.get((node, mask)) if mask > 0 else R1_find_best_links(G, G1, K, node, naive, rng)
+			if result is None:
+				result = table[(node, mask)] = _local_decisions(G, node, mask, naive)
+			while type(result) is tuple:
+				result = rng.ran.choice(result)
+			Pt.extend(result)
+	ret = stitch_paths(Pt, trusted)
 	for path in ret:
 		for pathi in range(len(path)-1):
 			G1.remove_edge(path[pathi], path[pathi+1])
 	return ret
 
-def R1(G,G1,K):
+def stitch_paths(segments, trusted):
+	"""
+	Joins the swaps [a, node, b] chosen by local routing into paths between trusted nodes,
+	whatever order the segments come in. Every node swaps disjoint pairs of its links, so
+	following the swaps from a trusted node's link walks one chain, which either ends at
+	another trusted node or breaks off. Each chain is walked from both ends and kept from
+	the lower one, and chains that come back to where they started are dropped.
+	"""
+	swaps = collections.defaultdict(dict)
+	for (a, node, b) in segments:
+		swaps[node][a] = b
+		swaps[node][b] = a
+	trusted = set(trusted)
+	Pt = []
+	for (a, node, b) in segments:
+		for start in (a, b):
+			if start not in trusted:
+				continue
+			path = [start]
+			(prev, cur) = (start, node)
+			while True:
+				path.append(cur)
+				nxt = swaps[cur][prev]
+				if nxt in trusted:
+					path.append(nxt)
+					if nxt > start:
+						Pt.append(path)
+					break
+				if cur not in swaps.get(nxt, ()):
+					break
+				(prev, cur) = (cur, nxt)
+	return Pt
+
+def R1(G,G1,K, rng):
 	trusted =  G.get_trusted()
+	pairs = [(TN1,TN2) for TN1 in trusted for TN2 in trusted if TN1 < TN2]
 	Pt = []
-	first_flag = False
-	#G1.show_graph()
-	# print("---")
+	# One BFS per trusted node gives every pair's current distance. After a path is taken only
+	# the trusted nodes with a removed edge on a shortest path to another trusted node are
+	# searched again. Distances only grow as edges go, so the old tables are lower bounds and
+	# checking with <= never misses a pair that got longer.
+	dist = {t: G1.bfs_distances(t, trusted) for t in trusted}
+	rank = None
+	def on_shortest(t, b, u, v):
+		dt, db = dist[t], dist[b]
+		return b in dt and u in dt and v in db and dt[u]+1+db[v] <= dt[b]
 	while True:
-		shortest_paths = []
-		for TN1 in trusted:
-			for TN2 in trusted:
-				if TN1 < TN2:
-					shortest_paths.append(G1.shortest_path(TN1, TN2))
-		adds = [p for p in shortest_paths if len(p)!=0]
-		#print("lens ", [[x[0],x[-1],len(x)] if x else "" for x in shortest_paths])
-		#print("Paths", adds)
-		mina = min(adds, key = lambda x: len(x)) if adds else []
-		#print("mina =", mina)
-		adds = [p for p in adds if len(p) == len(mina)]
-		#print("chosing from", adds)
-		add = PRNG_ran.choice(adds) if adds else []
-		#add = adds[-1] if adds else []
-		#print("chose", add)
-		# print("")
-		if add:
-			#print("{} -> {} len {}".format(add[0],add[-1], len(add)))
-			#print("Adding", add)
-			#if len(add) != 7 and ((add[0],add[-1]) == (0,24) or (add[0],add[-1]) == (24,48)):
-				# print("Added so far:", [(x,len(x)) for x in Pt])
-				# print("Paths", adds)
-				# print("mina =", mina)
-				# print("chose from", adds)
-				# print("Adding", add, len(add))
-				# G1.show_graph()
-			add = adds[-1] if adds else []
-			for j in range(len(add)-1):
-				G1.remove_edge(add[j], add[j+1])
-			Pt.append(add)
-		else:
-			#print("Breaking")
+		lens = [dist[TN1].get(TN2) for (TN1,TN2) in pairs]
+		found = [l for l in lens if l is not None]
+		if not found:
 			break
-	#print("Added ", Pt)
-	#print("------")
-	#G1.show_graph()
+		mina = min(found)
+		adds = [pairs[x] for x in range(len(pairs)) if lens[x] == mina]
+		# ties go to the last shortest pair, as they always have
+		(TN1,TN2) = adds[-1]
+		if rank is None:
+			# the round's edge order, taken once before any path's edges go
+			rank = G1.set_rank()
+		add = G1.shortest_path(TN1, TN2, rank)
+		removed = [(add[j], add[j+1]) for j in range(len(add)-1)]
+		for (u,v) in removed:
+			G1.remove_edge(u, v)
+		Pt.append(add)
+		stale = [t for t in trusted if any(on_shortest(t, b, u, v) or on_shortest(t, b, v, u)
+				for b in trusted if b != t for (u,v) in removed)]
+		for t in stale:
+			dist[t] = G1.bfs_distances(t, trusted)
 	return Pt
 
-def path_ent(G, Q, D, Pt):
+def path_odds(Q, D, p):
+	# (chance the swaps along path p succeed, chance its channel keeps its bit)
+	prob_suc = 1
+	prob_dep = 1-D[p[0]][p[1]]
+	for i in range(len(p[1:-1])):
+		pi = p[i]
+		pi2 = p[i+1]
+		try:
+			prob_suc *= Q[pi]
 
-	G2 = GridGraph(G.get_dim(), G.get_trusted())
+		except:
+			log.error("%s %s %s", prob_suc, Q, pi)
+		try:
+			prob_dep *= (1-D[pi][pi2])
+		except:
+			log.error("%s %s", pi, pi2)
+			raise RuntimeError
+	return prob_suc, prob_dep + (1-prob_dep)/2
+
+def path_ent(G, Q, D, Pt, rng):
+
+	G2 = G.live_copy(0)
 	G2.set_nodes(G.get_trusted())
 	edges = []
 
 	for p in Pt:
-		prob_suc = 1
-		prob_dep = 1-D[p[0]][p[1]]
-		for i in range(len(p[1:-1])):
-			pi = p[i]
-			pi2 = p[i+1]
-			try:
-				prob_suc *= Q[pi]
-
-			except:
-				print(prob_suc, Q, pi)
-			try:
-				prob_dep *= (1-D[pi][pi2])
-			except:
-				print(pi, pi2)
-				raise RuntimeError
-		prob_dep = prob_dep + (1-prob_dep)/2
-		rand = PRNG_ent.random()
+		(prob_suc, prob_dep) = path_odds(Q, D, p)
+		rand = rng.ent.random()
 
 		if rand <= prob_suc and p[0] in G2.get_trusted() and p[-1] in G2.get_trusted():
-			edges.append((p[0],p[-1], int(PRNG_ent.random() > prob_dep)))
+			edges.append((p[0],p[-1], int(rng.ent.random() > prob_dep)))
 	G2.set_edges([(e[0],e[1]) for e in edges ])
 	return G2, edges
 
-def attempt_QKD(G, Ed, Pz, Px, K, Kb):
+def attempt_QKD(G, Ed, Pz, Px, K, Kb, rng):
 	for edge in Ed:
-		if PRNG_qkd.random() <= Pz*Pz+Px*Px:
+		if rng.qkd.random() <= Pz*Pz+Px*Px:
 			i = min(edge[0], edge[1])
 			j = max(edge[0], edge[1])
 			K[i][j] +=1
-			Kb[i][j]+=str(int(edge[2]))
-	G3 = GridGraph(G.get_dim(), G.get_trusted())
-	G3.set_nodes(G.get_trusted())
-	G3.set_edges(G.get_edges())
+			Kb[i][j].append(int(edge[2]))
+	G3 = G.live_copy()
 	return G3, K, Kb
 
-def R2_regular(G,K,Kb):
+def R2_regular(G,K,Kb, rng):
 	old_K = deepcopy(K)
 	old_Kb = deepcopy(Kb)
 	for i in K:
@@ -366,276 +1160,1052 @@ def R2_regular(G,K,Kb):
 			if not K[i][j]:
 				continue
 
-			errors = Kb[i][j].count("1")
+			errors = Kb[i][j].count_ones()
 			Q = float(errors/K[i][j])
 			K[i][j] = max(0,int((1-2*binary_entropy(Q))*K[i][j]))
-			Kb[i][j] = "0"*K[i][j]
-			try:
-				print("		{} - > {} had {} raw bits and {} errors, error rate of {} resulting in {} secret key bits".format(i, j,old_K[i][j],errors,Q, K[i][j]))
-			except:		
-				print("		{} - > {} had {} bits and {} errors, error rate of {}".format(k, kb, k_errors[k][kb][0],k_errors[k][kb][1],0))
-				
+			Kb[i][j].reset(K[i][j])
+			log.debug("		%s - > %s had %s raw bits and %s errors, error rate of %s resulting in %s secret key bits", i, j, old_K[i][j], errors, Q, K[i][j])
 			
-	#print("+++++++++++++++++++++++++++++++++++++++++++++")
-	c=0
-	while True:
-		c+=1
-		#print("-------------------- Loop {} ------------".format(c))
-		# print(K)
-		start_nodes, end_nodes, capacities = [],[],[]
-		for i in K:
-			for j in K[i]: #chnaged k to kb
-			#if Kb[i][j]:
-				start_nodes.append(i)		
-				end_nodes.append(j)
-				capacities.append(K[i][j])
-		# print(start_nodes)
-		# print(end_nodes)
-		# print(capacities)
-		if not (start_nodes and end_nodes and capacities):# or not min(K) in start_nodes or not max(K) in end_nodes:
-			return 0, 0, old_K, old_Kb
-		flow = maxflow_ortools(start_nodes, end_nodes, capacities)
-
-		##error stuff
-		flows = []
-		for i in range(flow.NumArcs()):
-			for j in range(i,flow.NumArcs()):
-				if flow.Head(i) == flow.Tail(j) and (flow.Head(i)!=flow.Tail(i)) and (flow.Flow(j) and flow.Flow(i)):
-					# print('	%1s -> %1s   %3s  / %3s' % (flow.Tail(i),flow.Head(i),flow.Flow(i),flow.Capacity(i)))
-					# print('	%1s -> %1s   %3s  / %3s' % (flow.Tail(j),flow.Head(j),flow.Flow(j),flow.Capacity(j)))
-					flows.append([flow.Tail(i), flow.Head(i), flow.Head(j), flow.Flow(j)])
-					#print(flows[-1])
-		# print("Flows is ", flows)
-		if len(flows) <= 1:
-			
-			print("	Breaking flows")
-			break
-		for f in flows:
-			# print("consiering at", f)
-			if True or not (f[0] == min(K) and f[1] == max(K)):
-				try:
-					new_str = "".join([str(int(Kb[f[0]][f[1]][i]) ^ int(Kb[f[1]][f[2]][i])) for i in range(f[3])])
-					# print("Looking at", f)
-				except Exception as e:
-					print("Error")
-					print("Flow", f)
-					print("Kb[{}][{}]".format(f[0],f[1]), Kb[f[0]][f[1]])
-					print("Kb[{}][{}]".format(f[1],f[2]), Kb[f[1]][f[2]])
-					print(e)
-					raise RuntimeError
-				# print("1", Kb[f[0]][f[1]])
-				# print("2", Kb[f[1]][f[2]])
-				# print("xor" ,new_str)
-
-				# print("old", Kb[f[0]][f[2]])
-				Kb[f[0]][f[1]] = Kb[f[0]][f[1]][f[3]:]
-				Kb[f[1]][f[2]] = Kb[f[1]][f[2]][f[3]:]
-				Kb[f[0]][f[2]] += new_str
-
-				K[f[0]][f[1]] -=f[3]
-				K[f[1]][f[2]] -=f[3]
-				K[f[0]][f[2]] +=f[3]
-				# print("old1",Kb[f[0]][f[1]])
-				# print("old2",Kb[f[1]][f[2]])
-
-				# print("new",Kb[f[0]][f[2]])
-				break
-	if flows:
-		f= flows[0]
+	start_nodes, end_nodes, capacities = [],[],[]
+	for i in K:
+		for j in K[i]:
+			start_nodes.append(i)		
+			end_nodes.append(j)
+			capacities.append(K[i][j])
+	if not (start_nodes and end_nodes and capacities):
+		return 0, 0, old_K, old_Kb
+	source, sink = min(start_nodes), max(end_nodes)
+	(value, flows) = maxflow(start_nodes, end_nodes, capacities, source, sink)
+
+	# Every unit of flow is a key bit that reaches the sink through a chain of trusted nodes.
+	# Relaying each path of the decomposition straight into the source-sink pool spends the
+	# same bits the old relay-one-hop-and-resolve loop did, with a single max flow solve.
+	arc_flows = collections.Counter()
+	for i in range(len(flows)):
+		arc_flows[(start_nodes[i], end_nodes[i])] += flows[i]
+	for (path, amount) in decompose_flow(arc_flows, source, sink):
 		try:
-			new_str = "".join([str(int(Kb[f[0]][f[1]][i]) ^ int(Kb[f[1]][f[2]][i])) for i in range(f[3])])
-			# print("Looking at", f)
+			relay_path(Kb, path, amount, rng)
 		except Exception as e:
-			print("Error")
-			print("Flow", f)
-			print("Kb[{}][{}]".format(f[0],f[1]), Kb[f[0]][f[1]])
-			print("Kb[{}][{}]".format(f[1],f[2]), Kb[f[1]][f[2]])
-			print(e)
+			log.error("Error\nPath %s %s\n%s\n%s", path, amount,
+					"\n".join(["Kb[{}][{}] {}".format(path[j],path[j+1], Kb[path[j]][path[j+1]]) for j in range(len(path)-1)]), e)
 			raise RuntimeError
-		# print("1", Kb[f[0]][f[1]])
-		# print("2", Kb[f[1]][f[2]])
-		# print("xor" ,new_str)
+		for j in range(len(path)-1):
+			K[path[j]][path[j+1]] -= amount
+		K[source][sink] += amount
+	errors = Kb[source][sink].count_ones()
 
-		# print("old", Kb[f[0]][f[2]])
-		Kb[f[0]][f[1]] = Kb[f[0]][f[1]][f[3]:]
-		Kb[f[1]][f[2]] = Kb[f[1]][f[2]][f[3]:]
-		Kb[f[0]][f[2]] += new_str
+	##reset K, Kb
+	Kb[source][sink].reset()
+	K[source][sink] -= value
+	return value, errors, K, Kb
+
+def decompose_flow(arc_flows, source, sink):
+	"""
+	Splits a source-sink flow, given as {(tail, head): flow}, into paths. Returns a list of
+	(path, amount) with path the node list from source to sink; the amounts add up to the flow
+	value. Flow on cycles is cancelled rather than reported.
+	"""
+	remaining = dict([(a, f) for (a, f) in arc_flows.items() if f > 0 and a[0] != a[1]])
+	out = collections.defaultdict(list)
+	for (u,v) in sorted(remaining):
+		out[u].append(v)
+	nxt = collections.defaultdict(int) # first arc out of each node that may still carry flow
+	paths = []
+	path = [source]
+	while True:
+		u = path[-1]
+		if u == sink:
+			amount = min([remaining[(path[j], path[j+1])] for j in range(len(path)-1)])
+			for j in range(len(path)-1):
+				remaining[(path[j], path[j+1])] -= amount
+			paths.append((path, amount))
+			path = [source]
+			continue
+		while nxt[u] < len(out[u]) and remaining[(u, out[u][nxt[u]])] == 0:
+			nxt[u] += 1
+		if nxt[u] == len(out[u]):
+			if u == source:
+				return paths
+			raise ValueError("flow is not conserved at node {}".format(u))
+		v = out[u][nxt[u]]
+		if v in path:
+			cycle = path[path.index(v):] + [v]
+			amount = min([remaining[(cycle[j], cycle[j+1])] for j in range(len(cycle)-1)])
+			for j in range(len(cycle)-1):
+				remaining[(cycle[j], cycle[j+1])] -= amount
+			path = path[:path.index(v)+1]
+		else:
+			path.append(v)
+
+def relay_path(Kb, path, n, rng):
+	# moves n key bits from every hop of path into the pool between its two ends, with the
+	# intermediate trusted nodes announcing XORs; a bit ends up wrong when an odd number of the
+	# hops it used were
+	if len(path) <= 2 or not n:
+		return
+	(a, c) = (path[0], path[-1])
+	if isinstance(Kb[a][c], CountPool):
+		hops = [Kb[path[j]][path[j+1]].take(n, rng) for j in range(len(path)-1)]
+		ones = hops[0]
+		for hop in hops[1:]:
+			both = _split_errors(ones, n - ones, hop, rng)
+			ones = ones + hop - 2*both
+		Kb[a][c].add_counts(n, ones)
+	else:
+		hops = [Kb[path[j]][path[j+1]].take(n) for j in range(len(path)-1)]
+		Kb[a][c].extend(np.bitwise_xor.reduce(hops))
 
-		K[f[0]][f[1]] -=f[3]
-		K[f[1]][f[2]] -=f[3]
-		K[f[0]][f[2]] +=f[3]
-		# print("old1",Kb[f[0]][f[1]])
-		# print("old2",Kb[f[1]][f[2]])
+class OrToolsMaxFlow:
+	# OR-Tools SimpleMaxFlow. The solver is kept between calls and, when the arcs are the same
+	# as last time, only their capacities are updated.
+	name = "ortools"
 
-		# print("new",Kb[f[0]][f[2]])
-	errors = Kb[min(Kb)][max(Kb)].count("1")
-	# print("Error string is " ,len(Kb[min(Kb)][max(Kb)]))
+	def __init__(self):
+		try:
+			from ortools.graph.python import max_flow
+			self._new_api = True
+			self._make = max_flow.SimpleMaxFlow
+		except ImportError:
+			from ortools.graph import pywrapgraph # OR-Tools before 9.4
+			self._new_api = False
+			self._make = pywrapgraph.SimpleMaxFlow
+		self._solver = None
+		self._arcs = None
+
+	def solve(self, start_nodes, end_nodes, capacities, source, sink):
+		arcs = (tuple(start_nodes), tuple(end_nodes))
+		if self._new_api:
+			if arcs != self._arcs:
+				self._solver = self._make()
+				self._ids = self._solver.add_arcs_with_capacity(np.array(start_nodes, dtype=np.int32), np.array(end_nodes, dtype=np.int32), np.array(capacities, dtype=np.int64))
+				self._arcs = arcs
+			else:
+				self._solver.set_arcs_capacity(self._ids, np.array(capacities, dtype=np.int64))
+			status = self._solver.solve(source, sink)
+			if status != self._solver.OPTIMAL:
+				raise RuntimeError("max flow solver returned status {}".format(status))
+			return self._solver.optimal_flow(), [int(f) for f in self._solver.flows(self._ids)]
+		if arcs != self._arcs:
+			self._solver = self._make()
+			for i in range(0, len(start_nodes)):
+				self._solver.AddArcWithCapacity(start_nodes[i], end_nodes[i], capacities[i])
+			self._arcs = arcs
+		else:
+			for i in range(0, len(start_nodes)):
+				self._solver.SetArcCapacity(i, capacities[i])
+		status = self._solver.Solve(source, sink)
+		if status != self._solver.OPTIMAL:
+			raise RuntimeError("max flow solver returned status {}".format(status))
+		return self._solver.OptimalFlow(), [self._solver.Flow(i) for i in range(len(start_nodes))]
+
+class NetworkxMaxFlow:
+	name = "networkx"
+
+	def solve(self, start_nodes, end_nodes, capacities, source, sink):
+		import networkx as nx
+		G = nx.DiGraph()
+		G.add_nodes_from([source, sink])
+		for (u, v, c) in zip(start_nodes, end_nodes, capacities):
+			if u == v:
+				continue
+			if G.has_edge(u, v):
+				G[u][v]["capacity"] += c
+			else:
+				G.add_edge(u, v, capacity=c)
+		value, flow_dict = nx.maximum_flow(G, source, sink)
+		# hand each arc its share of the flow between its end points, in input order
+		flows = []
+		for (u, v, c) in zip(start_nodes, end_nodes, capacities):
+			f = 0 if u == v else min(c, flow_dict[u][v])
+			if f:
+				flow_dict[u][v] -= f
+			flows.append(f)
+		return value, flows
+
+class DinicMaxFlow:
+	# Dinic's algorithm over flat arc arrays: arc 2k is input arc k and 2k+1 its residual twin.
+	name = "native"
+
+	def solve(self, start_nodes, end_nodes, capacities, source, sink):
+		nodes = sorted(set(start_nodes) | set(end_nodes) | set([source, sink]))
+		index = {v: i for i, v in enumerate(nodes)}
+		head = []
+		residual = []
+		out = [[] for v in nodes]
+		for (u, v, c) in zip(start_nodes, end_nodes, capacities):
+			out[index[u]].append(len(head))
+			head.append(index[v])
+			residual.append(c if u != v else 0)
+			out[index[v]].append(len(head))
+			head.append(index[u])
+			residual.append(0)
+		s, t = index[source], index[sink]
+		value = 0
+		while s != t:
+			level = [-1]*len(nodes)
+			level[s] = 0
+			fringe = [s]
+			while fringe:
+				next_fringe = []
+				for u in fringe:
+					for a in out[u]:
+						if residual[a] and level[head[a]] < 0:
+							level[head[a]] = level[u] + 1
+							next_fringe.append(head[a])
+				fringe = next_fringe
+			if level[t] < 0:
+				break
+			nxt = [0]*len(nodes)
+			while True:
+				# find one augmenting path in the level graph, walking forward and retreating
+				# from dead ends
+				path = []
+				u = s
+				while u != t:
+					while nxt[u] < len(out[u]):
+						a = out[u][nxt[u]]
+						if residual[a] and level[head[a]] == level[u] + 1:
+							break
+						nxt[u] += 1
+					if nxt[u] == len(out[u]):
+						if u == s:
+							break
+						level[u] = -1
+						a = path.pop()
+						u = head[a ^ 1]
+						continue
+					path.append(out[u][nxt[u]])
+					u = head[path[-1]]
+				if u != t:
+					break
+				push = min([residual[a] for a in path])
+				for a in path:
+					residual[a] -= push
+					residual[a ^ 1] += push
+				value += push
+		flows = [residual[2*k+1] if start_nodes[k] != end_nodes[k] else 0 for k in range(len(start_nodes))]
+		return value, flows
+
+MAXFLOW_BACKENDS = {"ortools": OrToolsMaxFlow, "networkx": NetworkxMaxFlow, "native": DinicMaxFlow}
+MAXFLOW_BACKEND = None # one of MAXFLOW_BACKENDS, or None for OR-Tools when it imports and native otherwise
+_maxflow_solver = None
+
+def set_maxflow_backend(name):
+	global MAXFLOW_BACKEND
+	global _maxflow_solver
+	if name is not None and name not in MAXFLOW_BACKENDS:
+		raise ValueError("unknown max flow backend {}, expected one of {}".format(name, sorted(MAXFLOW_BACKENDS)))
+	MAXFLOW_BACKEND = name
+	_maxflow_solver = None
+
+def get_maxflow_solver():
+	global _maxflow_solver
+	if _maxflow_solver is None or (MAXFLOW_BACKEND is not None and _maxflow_solver.name != MAXFLOW_BACKEND):
+		if MAXFLOW_BACKEND is not None:
+			_maxflow_solver = MAXFLOW_BACKENDS[MAXFLOW_BACKEND]()
+		else:
+			try:
+				_maxflow_solver = OrToolsMaxFlow()
+			except ImportError:
+				_maxflow_solver = DinicMaxFlow()
+	return _maxflow_solver
 
-	##reset K, Kb
-	Kb[min(Kb)][max(Kb)]=""
-	for i in range(flow.NumArcs()):
-		K[flow.Tail(i)][flow.Head(i)]-=flow.Flow(i)
-	#print(Kb)
-	#print(K)
-	# print("Flows", flows)
-	# print("maxflow", flow.OptimalFlow())
-	return flow.OptimalFlow(), errors, K, Kb
-
-def maxflow_ortools(start_nodes, end_nodes, capacities):
-  """MaxFlow simple interface example."""
-
-  # Define three parallel arrays: start_nodes, end_nodes, and the capacities
-  # between each pair. For instance, the arc from node 0 to node 1 has a
-  # capacity of 20.
-
-  #start_nodes = []  #[0, 0, 0, 1, 1, 2, 2, 3, 3]
-  #end_nodes =   []  #[1, 2, 3, 2, 4, 3, 4, 2, 4]
-  #capacities =  []  #[20, 30, 10, 40, 30, 10, 20, 5, 20]
-  # Instantiate a SimpleMaxFlow solver.
-  max_flow = pywrapgraph.SimpleMaxFlow()
-  # Add each arc.
-  for i in range(0, len(start_nodes)):
-    max_flow.AddArcWithCapacity(start_nodes[i], end_nodes[i], capacities[i])
-
-  # Find the maximum flow between node 0 and node 4.
-  try:
-	  if max_flow.Solve(min(start_nodes),max(end_nodes) ) == max_flow.OPTIMAL:
-	  	
-	    # print('Max flow:', max_flow.OptimalFlow())
-	    # print('')
-	    # print('  Arc    Flow / Capacity')
-	    # for i in range(max_flow.NumArcs()):
-	    #   print('%1s -> %1s   %3s  / %3s' % (
-	    #       max_flow.Tail(i),
-	    #       max_flow.Head(i),
-	    #       max_flow.Flow(i),
-	    #       max_flow.Capacity(i)))
-	    # # print('Source side min-cut:', max_flow.GetSourceSideMinCut())
-	    # print('Sink side min-cut:', max_flow.GetSinkSideMinCut())
-	    pass
-	  else:
-	    print('There was an issue with the max flow input.')
-	    # print(start_nodes)
-	    # print(end_nodes)
-	    # print(capacities)
-	    raise RuntimeError
-  except Exception as e:
-    print(start_nodes)
-    print(end_nodes)
-    print(capacities)
-    print(e)
-    raise RuntimeError
-
-  
-  return max_flow
-
-
-seed1 = "gen"
-seed2 = "ran"
-seed3 = "ent"
-seed4 = "qkd"
-PRNG_gen = None
-PRNG_ran = None
-PRNG_ent = None
-PRNG_qkd = None
-def main(N, n, T, p, q, d, Pz = 1/2, Px = 1/2, glob=False, naive=False):
-	#print(N, n, T, p, q, d, Pz , Px , glob, naive)
+def maxflow(start_nodes, end_nodes, capacities, source, sink):
+	# Returns (max flow value, flow on each input arc) using the selected backend.
+	try:
+		return get_maxflow_solver().solve(start_nodes, end_nodes, capacities, source, sink)
+	except Exception as e:
+		log.error("%s\n%s\n%s\n%s", start_nodes, end_nodes, capacities, e)
+		raise RuntimeError
+
+SEED = None # seed for every main() call; None draws a fresh one each call (it is logged)
+
+IMPORTANCE_GROUPS = 20 # round groups (round % IMPORTANCE_GROUPS) behind importance sampling's intervals
+IMPORTANCE_MIX = .5 # share of importance sampled rounds with a forced path
+
+def distilled_rate(pairs, bits, errors):
+	# key bits a round from raw bits and errors a round per (a, b) in pairs, by R2_regular's
+	# privacy amplification and max flow; capacities are scaled up to integers for the solver
+	secret = [max(0., (1-2*binary_entropy(e/b))*b) if b > 0 else 0. for (b, e) in zip(bits, errors)]
+	if not pairs or max(secret) <= 0:
+		return 0.
+	scale = 1e12 / max(secret)
+	nodes = [x for pair in pairs for x in pair]
+	value = maxflow([a for (a, b) in pairs], [b for (a, b) in pairs], [int(x*scale) for x in secret], min(nodes), max(nodes))[0]
+	return value / scale
+
+class ImportanceSampler:
+	"""
+	Importance sampling of pair_ent for rare paths. A share mix of the rounds (the first link
+	draw decides) pick a trusted link and one of its shortest paths uniformly, and that path's
+	Bell pairs all come up; every other edge draws as usual. Each round is weighed by its
+	likelihood ratio under this mixture,
+		1 / ((1-mix) + mix/links * sum over links of sum(1/P(path)) / paths),
+	the inner sum running over the link's shortest paths that are all up (a count over the
+	link's shortest path DAG). Weights never top 1/(1-mix). Routing and everything after it
+	draw as usual, so the weighted raw bits and errors of each pair, summed over rounds and
+	divided by the rounds run, are unbiased. Sums are kept per round group (round % groups)
+	to get intervals from the spread between groups.
+	"""
+	def __init__(self, G, P, K, streams, mix = IMPORTANCE_MIX, groups = IMPORTANCE_GROUPS):
+		self.streams = streams
+		self.mix = mix
+		self.probs = edge_probabilities(G, P)
+		index = {}
+		for (k, (u, v)) in enumerate(G.get_all_edges()):
+			index[(u, v)] = index[(v, u)] = k
+		dist = G.all_paths()
+		# per link: the shortest path DAG from a to b as (node, [(next node, edge)]) with the
+		# nodes nearest b first, and the number of paths from each node to b
+		self.dags = []
+		for (a, b, path) in trusted_links(G):
+			nodes = [u for u in G.get_nodes() if dist[a][u] >= 0 and dist[u][b] >= 0 and dist[a][u] + dist[u][b] == dist[a][b]]
+			dag = [(u, [(v, index[(u, v)]) for v in G.get_neighbors(u) if v in nodes and dist[v][b] == dist[u][b] - 1 and self.probs[index[(u, v)]] > 0])
+					for u in sorted(nodes, key=lambda u: dist[u][b])]
+			paths = {b: 1}
+			for (u, out) in dag[1:]:
+				paths[u] = sum([paths[v] for (v, k) in out])
+			self.dags.append((a, b, dag, dict(dag), paths))
+		self.width = (2 + max([len(dag) for (a, b, dag, out, paths) in self.dags] or [0]) + 3) // 4
+		self.pairs = [(a, b) for a in K for b in K[a] if a < b]
+		self.sums = np.zeros((groups, len(self.pairs), 2))
+		self._seen = [(0, 0) for pair in self.pairs]
+
+	def draw(self, rngs):
+		# Bell pair masks of the consecutive rounds rngs, a row per round
+		masks = np.array([rng.edges for rng in rngs]) < self.probs
+		if not self.dags:
+			return masks
+		draws = self.streams.link_draws(rngs[0].round, len(rngs), self.width).reshape(len(rngs), -1)
+		for r in np.flatnonzero(draws[:, 0] < self.mix):
+			(a, b, dag, out, paths) = self.dags[min(int(draws[r, 1]*len(self.dags)), len(self.dags)-1)]
+			(u, step) = (a, 2)
+			while u != b:
+				# the next hop is drawn in proportion to the paths through it
+				x = draws[r, step] * paths[u]
+				for (v, k) in out[u]:
+					x -= paths[v]
+					if x < 0:
+						break
+				masks[r, k] = True
+				(u, step) = (v, step + 1)
+		return masks
+
+	def weight(self, live):
+		# likelihood ratio of a round whose Bell pairs are the live bitset
+		up = np.zeros(len(self.probs), dtype=bool)
+		up[list(_bit_indices(live))] = True
+		forced = 0.
+		for (a, b, dag, out, paths) in self.dags:
+			# sum of 1/P(path) over the shortest paths that are up, from b back to a
+			f = {b: 1.}
+			for (u, edges) in dag[1:]:
+				f[u] = sum([f[v] / self.probs[k] for (v, k) in edges if up[k]])
+			forced += f[a] / paths[a]
+		return 1 / ((1 - self.mix) + self.mix * forced / len(self.dags)) if self.dags else 1.
+
+	def state(self):
+		return {"importance": self.sums}
+
+	def restore(self, state, K, Kb):
+		self.sums = state["importance"]
+		self._seen = [(K[a][b], Kb[a][b].count_ones()) for (a, b) in self.pairs]
+
+	def add(self, r, live, K, Kb):
+		# weighs the raw bits and errors round r, whose Bell pairs were live, just added to K and Kb
+		w = None
+		for (k, (a, b)) in enumerate(self.pairs):
+			if K[a][b] != self._seen[k][0]:
+				if w is None:
+					w = self.weight(live)
+				seen = (K[a][b], Kb[a][b].count_ones())
+				self.sums[r % len(self.sums), k] += w * (seen[0] - self._seen[k][0]), w * (seen[1] - self._seen[k][1])
+				self._seen[k] = seen
+
+	def estimate(self, rounds, z):
+		# (raw rate, ci, qber, ci, key rate, ci) over rounds 0 to rounds-1
+		groups = len(self.sums)
+		n = [(rounds - g + groups - 1) // groups for g in range(groups)]
+		(rate, rate_ci, qber, qber_ci) = batch_estimate([(n[g],) + tuple(self.sums[g].sum(axis=0)) for g in range(groups) if n[g]], z)
+		pooled = self.sums.sum(axis=0) / rounds
+		key = distilled_rate(self.pairs, pooled[:, 0], pooled[:, 1])
+		keys = [distilled_rate(self.pairs, self.sums[g, :, 0] / n[g], self.sums[g, :, 1] / n[g]) for g in range(groups) if n[g]]
+		key_ci = z * float(np.std(keys, ddof=1)) / math.sqrt(len(keys)) if len(keys) > 1 else float("inf")
+		return float(rate), float(rate_ci), float(qber), float(qber_ci), float(key), key_ci
+
+def run_round(G, G1, Q, D, K, Kb, Pz, Px, glob, naive, rng, tm, sampler = None, engine = None):
+	# routing, path_ent and QKD for one round whose Bell pairs are G1, timed into tm, and
+	# weighed by sampler if pair_ent was importance sampled. A protocol engine does the
+	# swapping and key exchange in place of path_ent and attempt_QKD.
+	start = time.perf_counter()
+	live = G1.get_live()
+	Pt = R1(G, G1, K, rng) if glob else local_R1(G, G1, K, naive, rng) #for two trusted nodes old global R1 is actually better.
+	routed = time.perf_counter()
+	if engine is None:
+		(G2, Ed) = path_ent(G, Q, D, Pt, rng)
+		entangled = time.perf_counter()
+		(G3, K, Kb) = attempt_QKD(G2, Ed, Pz, Px, K, Kb, rng)
+	else:
+		(G2, links) = engine.swap(G, Q, D, Pt, rng)
+		entangled = time.perf_counter()
+		Ed = engine.exchange(links, Q, D, K, Kb, rng)
+		engine.end_round()
+		G3 = G2.live_copy()
+	if sampler is not None:
+		sampler.add(rng.round, live, K, Kb)
+	tm.add("routing", routed - start)
+	tm.add("path_ent", entangled - routed)
+	tm.add("QKD", time.perf_counter() - entangled)
+	return Pt, Ed, G3
+
+def play_rounds(G, P, Q, D, K, Kb, r0, r1, Pz, Px, glob, naive, streams, tm, total = None, sampler = None, engine = None):
+	# rounds r0 to r1-1 of main(), one at a time: pair_ent, routing, path_ent and QKD (or the
+	# engine's rounds). Returns the (path length, paths, channels, decohered) totals of these
+	# rounds and the last round's G3. Progress is reported out of total rounds (r1 by default).
+	total = total or r1
+	edge_count = len(G.get_all_edges())
+	(pathlength, paths, channels, decohered) = (0, 0, 0, 0)
+	G3 = None
+	rngs = []
+	i = r0
+	while i < r1:
+		if not rngs:
+			# the streams are fetched a chunk of rounds at a time; each round still gets its own
+			rngs = streams.rounds(i, min(256, r1-i), edge_count)[::-1]
+		rng = rngs.pop()
+		i+=1
+		if tm.progress and i % (total/20) == 0 :
+			tm.progress(i, total)
+		#print("-------Entanglement Graph-----------")
+		started = time.perf_counter()
+		if engine is not None:
+			G1 = engine.pair_ent(G, rng)
+		else:
+			G1 = pair_ent(G,P, rng) if sampler is None else G.live_copy(mask_to_live(sampler.draw([rng])[0]))
+		tm.add("pair_ent", time.perf_counter() - started)
+		#print("-------Routing Ent-----------")
+		(Pt, Ed, G3) = run_round(G, G1, Q, D, K, Kb, Pz, Px, glob, naive, rng, tm, sampler, engine)
+		pathlength += sum([len(x)-1 for x in Pt])
+		paths += len(Pt)
+		channels+=len(Ed)
+		decohered += sum([x[-1] for x in Ed])
+	return (pathlength, paths, channels, decohered), G3
+
+CHECKPOINT_EVERY = 10000 # rounds between main() checkpoints
+ADAPTIVE_BATCHES = 10 # batches in the first N rounds of an adaptive main() run
+ADAPTIVE_BUDGET = 100 # default round budget of an adaptive run, in multiples of N
+
+def raw_counts(Kb):
+	# (raw bits, errors) over every key pool
+	return (sum([len(Kb[a][b]) for a in Kb for b in Kb[a]]), sum([Kb[a][b].count_ones() for a in Kb for b in Kb[a]]))
+
+def batch_estimate(batches, z):
+	"""
+	Raw key rate per round and QBER from batches of (rounds, raw bits, errors), with the half-widths
+	of their confidence intervals (z standard errors) from the spread of the batch means. Both are
+	ratio estimates, so batches need not be the same size. Returns (rate, rate_ci, qber, qber_ci).
+	"""
+	b = np.array(batches, dtype=float).reshape(-1, 3)
+	k = len(b)
+	(rounds, bits, errors) = b.sum(axis=0)
+	rate = bits/rounds if rounds else 0.
+	qber = errors/bits if bits else 0.
+	if k < 2 or not bits:
+		return rate, float("inf"), qber, float("inf")
+	rate_se = math.sqrt(((b[:, 1] - rate*b[:, 0])**2).sum() / (k*(k-1))) / (rounds/k)
+	qber_se = math.sqrt(((b[:, 2] - qber*b[:, 1])**2).sum() / (k*(k-1))) / (bits/k)
+	return rate, z*rate_se, qber, z*qber_se
+
+def converged(estimate, precision):
+	# both half-widths within precision of their estimates (a QBER of 0 with no spread counts)
+	(rate, rate_ci, qber, qber_ci) = estimate
+	return rate > 0 and rate_ci <= precision*rate and qber_ci <= precision*qber
+
+def save_checkpoint(filename, run, seed, i, counters, K, Kb, state = None):
+	"""
+	Writes what main() needs to carry on after round i: the run's parameters, the seed, the
+	counters, K, every key pool (packed bits, or bit and error counts for CountPool) and the
+	arrays of a protocol engine's state.
+	Round streams only depend on (seed, scenario, round), so that is all the random state
+	there is. The file is replaced in one step, so a crash leaves the previous checkpoint.
+	"""
+	pairs = [(a, b) for a in sorted(Kb) for b in sorted(Kb[a])]
+	counts = np.array([[len(Kb[a][b]), Kb[a][b].count_ones(), K[a][b]] for (a, b) in pairs], dtype=np.int64).reshape(-1, 3)
+	if pairs and isinstance(Kb[pairs[0][0]][pairs[0][1]], KeyPool):
+		bits = np.packbits(np.concatenate([Kb[a][b].bits() for (a, b) in pairs]), bitorder="little")
+	else:
+		bits = np.zeros(0, dtype=np.uint8)
+	tmp = filename + ".tmp"
+	with open(tmp, "wb") as f:
+		np.savez_compressed(f, run=np.array(run), seed=np.array(str(seed)), round=np.array(i), counters=np.array(counters, dtype=np.int64),
+				pairs=np.array(pairs, dtype=np.int64).reshape(-1, 2), counts=counts, bits=bits,
+				**{"state_" + name: value for (name, value) in (state or {}).items()})
+	os.replace(tmp, filename)
+
+def load_checkpoint(filename, run, K, Kb):
+	# Restores K and Kb in place from a checkpoint of the same run; returns (seed, round, counters, state)
+	with np.load(filename) as data:
+		if str(data["run"]) != run:
+			raise ValueError("{} is a checkpoint of a different run: {}".format(filename, data["run"]))
+		bits = np.unpackbits(data["bits"], bitorder="little")
+		offset = 0
+		for ((a, b), (length, ones, k)) in zip(data["pairs"].tolist(), data["counts"].tolist()):
+			K[a][b] = k
+			Kb[a][b].reset()
+			if isinstance(Kb[a][b], KeyPool):
+				Kb[a][b].extend(bits[offset:offset+length])
+				offset += length
+			else:
+				Kb[a][b].add_counts(length, ones)
+		state = {name[6:]: data[name] for name in data.files if name.startswith("state_")}
+		return int(str(data["seed"])), int(data["round"]), data["counters"].tolist(), state
 
-	if T is None:
-		print("T=", T, "Aborting")
+def main(N, n, T, p, q, d, Pz = 1/2, Px = 1/2, glob=False, naive=False, seed=None, scenario=0, stats_only=False, stats=None,
+		checkpoint=None, checkpoint_every=None, telemetry=None, precision=None, max_rounds=None, confidence=.95, protocol=None,
+		importance=None):
+	#print(N, n, T, p, q, d, Pz , Px , glob, naive)
+	# With a checkpoint file the run is saved every checkpoint_every rounds (CHECKPOINT_EVERY by
+	# default) and picks up from the file if it is there, with the same results as a run that never
+	# stopped. The file is removed once the run is done. Stage times, counters and progress go to
+	# telemetry (a Telemetry), and stats also gets this run's stage times.
+	# With a precision, N is the least number of rounds: the run goes on in batches until the
+	# raw key rate and QBER confidence intervals are within precision of their estimates, or
+	# max_rounds (ADAPTIVE_BUDGET*N by default) have run. stats records the estimates reached.
+	# protocol is a ProtocolEngine or a PROTOCOLS name, for the rounds of that protocol in
+	# place of E91's (the default).
+	# With importance (a share of rounds, see ImportanceSampler), those rounds force a shortest
+	# path up and every round is weighed by its likelihood ratio. The return value and stats are
+	# then the unbiased weighted estimates, with stats also holding their confidence intervals.
+
+	if T is None and not isinstance(n, Topology):
+		log.warning("T= %s Aborting", T)
 		return -1,1
-	global PRNG_gen
-	global PRNG_ran
-	global PRNG_ent
-	global PRNG_qkd
-	PRNG_gen = random.Random(uuid.UUID(seed1) if type(seed1) is str else seed1) 
-	PRNG_ran = random.Random(uuid.UUID(seed2) if type(seed2) is str else seed2) 
-	PRNG_ent = random.Random(uuid.UUID(seed3) if type(seed3) is str else seed3) 
-	PRNG_qkd = random.Random(uuid.UUID(seed4) if type(seed4) is str else seed4) 
+	tm = telemetry or Telemetry()
+	before = tm.metrics()
 	#Set Up
-	(G,P,Q,D,K,Kb) = generate_network(n,T,p,q,d)
-	G.all_paths()
-	#print("Network Graph")
-	G.show_graph()
+	(G,P,Q,D,K,Kb) = generate_network(n,T,p,q,d, CountPool if stats_only else KeyPool)
+	run = repr((N, G.get_signature(), G.get_trusted(), p, q, d, Pz, Px, glob, naive, scenario, stats_only))
+	if precision:
+		budget = max(N, max_rounds or ADAPTIVE_BUDGET*N)
+		run = run[:-1] + ", {!r}, {!r}, {!r})".format(precision, budget, confidence)
+	engine = protocol
+	if isinstance(protocol, str):
+		engine = PROTOCOLS[protocol]() if PROTOCOLS[protocol] else None
+	if engine is not None:
+		run = run[:-1] + ", {!r})".format(engine)
+	if importance:
+		if engine is not None or precision:
+			raise ValueError("importance sampling only runs fixed length E91 rounds")
+		run = run[:-1] + ", {!r})".format(importance)
 	#Ma in Loop
 	pathlength1 = 0
 	paths1  = 0
 	i = 0
 	channels = 0
 	decohered = 0
-	while i < N:
-		#if i % 1000 == 0:
-		#	print('		{0}\r'.format("Completed {} out of {}".format(i,N)))
-		i+=1
-		if i % (N/20) == 0 :
-			print('|',end="")
-		if i == N:
-			print("")
-		#print("-------Entanglement Graph-----------")
-		G1 = pair_ent(G,P)
-		#G1.show_graph()
-		#print("-------Routing Ent-----------")
-		#G1b = deepcopy(G1)
-		Pt = R1(G, G1,K) if glob else local_R1(G,G1,K,naive) #for two trusted nodes old global R1 is actually better.
-		#Pt = [x for x in Pt if len(x) <= 11]
-		#print(Pt)
-		pathlength1 += sum([len(x)-1 for x in Pt])
-		paths1 += len(Pt)
-		
-
-		#print(Pt)
-		num = 0
-		
-		#G1.show_graph()
-
-		#print ("---------Trusted Connections---------\n")
-		(G2, Ed) = path_ent(G, Q, D, Pt)
-		channels+=len(Ed)
-		decohered += sum([x[-1] for x in Ed])
-
-		#print("	", Ed)
-		#G2.print_graph()
-
-		#print("\nAttempt QKD\n")
-
-		(G3, K, Kb) = attempt_QKD(G2, Ed, Pz, Px, K, Kb)
-		#G3.print_graph()
-
-	k_errors ={k:{k1:(K[k][k1], Kb[k][k1].count("1")) for k1 in Kb[k]} for k in Kb}
-
-	print("")
-	data_str = "Data for {} iterations, {}x{} Grid, L = {}, Q = {}, E = {}, Pz = {}, Global Info = {}, TN Type = {}"\
-			.format(N, n, n, round(p,3), q, d, Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular")
-	print(data_str)
-	(maxflow, errors, K, Kb) = R2_regular(G3,K, Kb)
-	
-	
-	print("Final Stats: {} rounds resulted in {} {} key bits with {} errors with {} TNs at {}".format(i, maxflow, "secret", errors, len(T)-2, T))
-	print("		Results in {} secret key bits".format( max(0,int((1-2*binary_entropy(float(errors/maxflow)))*maxflow)) if maxflow else 0 ))
-	print("Stats")
-	print("		Total connections ", paths1)
-	print("		Average connections ", paths1/i)
-	print("		Average connection length ", pathlength1/paths1 if paths1 else 0)
-	print("		Total established channels", channels)
-	print("		Total decohered channels", decohered)
-	print("		Average channels", channels/i)
-	print("		Average decohered", decohered/channels if channels else 0)
-
-	print("   DEBUG: Key Rate = {}".format((max(0,int((1-2*binary_entropy(float(errors/maxflow)))*maxflow)) if maxflow else 0)/N))
-	# for k in k_errors:
-	# 	for kb in k_errors:
-	# 		if k_errors[k][kb][0]:
-	# 			try:
-	# 				print("pre-		{} - > {} had {} bits and {} errors, error rate of {}".format(k, kb, k_errors[k][kb][0],k_errors[k][kb][1],k_errors[k][kb][1]/k_errors[k][kb][0]))
-	# 			except:		
-	# 				print("pre-		{} - > {} had {} bits and {} errors, error rate of {}".format(k, kb, k_errors[k][kb][0],k_errors[k][kb][1],0))
-	try:
-		print("		Overall had {} bits and {} errors, error rate of {}".format(maxflow, errors, errors/maxflow if maxflow else 0))
-	except:
-		print("		Overall had {} bits and {} errors, error rate of {}".format(maxflow, errors, 0))
-	print("")
+	batches = []
+	state = None
+	if checkpoint and os.path.exists(checkpoint):
+		(saved, i, counters, state) = load_checkpoint(checkpoint, run, K, Kb)
+		(pathlength1, paths1, channels, decohered) = counters[:4]
+		# an adaptive run also saves its batches as (rounds, raw bits, errors)
+		batches = [tuple(counters[k:k+3]) for k in range(4, len(counters), 3)]
+		if seed is not None and seed != saved:
+			raise ValueError("{} was written with seed {}, not {}".format(checkpoint, saved, seed))
+		seed = saved
+		log.info("Resuming from round %s of %s", i, checkpoint)
+	if seed is None:
+		seed = SEED if SEED is not None else np.random.SeedSequence().entropy
+	streams = RoundStreams(seed, scenario)
+	every = checkpoint_every or CHECKPOINT_EVERY
+	def save(done, counters):
+		if checkpoint and done < total:
+			save_checkpoint(checkpoint, run, seed, done, counters, K, Kb, (engine or sampler).state() if engine or sampler else None)
+	G.all_paths()
+	if engine is not None:
+		engine.setup(G, P, Q, D, Pz, Px)
+		if state:
+			engine.restore(state)
+	sampler = ImportanceSampler(G, P, K, streams, importance) if importance else None
+	if sampler is not None and state:
+		sampler.restore(state, K, Kb)
+	#print("Network Graph")
+	if log.isEnabledFor(logging.DEBUG):
+		graph = io.StringIO()
+		with contextlib.redirect_stdout(graph):
+			G.show_graph()
+		log.debug(graph.getvalue())
+	first = i
+	G3 = None
+	total = budget if precision else N
+	def advance(target, every):
+		# runs rounds i to target-1, checkpointing every `every` rounds (never if None)
+		nonlocal i, pathlength1, paths1, channels, decohered, G3
+		while i < target:
+			stop = min(target, (i // every + 1) * every) if every else target
+			(counts, G3) = play_rounds(G, P, Q, D, K, Kb, i, stop, Pz, Px, glob, naive, streams, tm, total, sampler, engine)
+			(pathlength1, paths1, channels, decohered) = [x + y for (x, y) in zip((pathlength1, paths1, channels, decohered), counts)]
+			i = stop
+			if every and i % every == 0:
+				save(i, (pathlength1, paths1, channels, decohered))
+	if precision:
+		# Batches of N/ADAPTIVE_BATCHES rounds until the raw key rate and QBER are known to within
+		# precision (relative half-width at `confidence`), but at least N and at most budget rounds.
+		step = max(1, N // ADAPTIVE_BATCHES)
+		z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+		last = (i, raw_counts(Kb))
+		saved = i
+		estimate = batch_estimate(batches, z)
+		while i < budget and not (i >= N and converged(estimate, precision)):
+			advance(min(i + step - i % step, budget), None)
+			counts = raw_counts(Kb)
+			batches.append((i - last[0], counts[0] - last[1][0], counts[1] - last[1][1]))
+			last = (i, counts)
+			estimate = batch_estimate(batches, z)
+			if checkpoint and i - saved >= every and i < budget:
+				save(i, [pathlength1, paths1, channels, decohered] + [x for b in batches for x in b])
+				saved = i
+		if tm.progress and i < total:
+			# close the bar of a run that stopped early
+			tm.progress(total, total)
+		(rate, rate_ci, qber, qber_ci) = estimate
+		log.info("Adaptive: %s rounds, raw key rate %s +- %s, QBER %s +- %s", i, rate, rate_ci, qber, qber_ci)
+	else:
+		advance(N, every)
+	tm.count("rounds", i - first)
+
+	data_str = "Data for {} iterations, {}, L = {}, Q = {}, E = {}, Pz = {}, Global Info = {}, TN Type = {}"\
+			.format(i, G.get_name(), round(p,3), q, d, Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular")
+	log.info(data_str)
+	log.info("Seed %s, scenario %s", seed, scenario)
+	raw = sum([K[a][b] for a in K for b in K[a]])
+	with tm.stage("R2"):
+		(maxflow, errors, K, Kb) = R2_regular(G3,K, Kb, streams.distill())
+	tm.count("raw_bits", raw)
+	tm.count("key_bits", maxflow)
+
+	if sampler is not None:
+		z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+		(rate, rate_ci, qber, qber_ci, key_rate, key_rate_ci) = sampler.estimate(i, z)
+		log.info("Importance sampled at %s: raw key rate %s +- %s, QBER %s +- %s, key rate %s +- %s", importance, rate, rate_ci, qber, qber_ci, key_rate, key_rate_ci)
+		# the biased run's key says nothing by itself; distillation leaves no errors in expectation
+		(maxflow, errors) = (int(round(key_rate*i)), 0)
+	secret = max(0,int((1-2*binary_entropy(float(errors/maxflow)))*maxflow)) if maxflow else 0
+	log.info("Final Stats: %s rounds resulted in %s %s key bits with %s errors with %s TNs at %s", i, maxflow, "secret", errors, len(G.get_trusted())-2, list(G.get_trusted()))
+	log.info("		Results in %s secret key bits", secret)
+	log.info("Stats")
+	log.info("		Total connections  %s", paths1)
+	log.info("		Average connections  %s", paths1/i)
+	log.info("		Average connection length  %s", pathlength1/paths1 if paths1 else 0)
+	log.info("		Total established channels %s", channels)
+	log.info("		Total decohered channels %s", decohered)
+	log.info("		Average channels %s", channels/i)
+	log.info("		Average decohered %s", decohered/channels if channels else 0)
+	log.debug("   DEBUG: Key Rate = %s", secret/i)
+	log.info("		Overall had %s bits and %s errors, error rate of %s", maxflow, errors, errors/maxflow if maxflow else 0)
+	if checkpoint and os.path.exists(checkpoint):
+		os.remove(checkpoint)
+	after = tm.metrics()
+	seconds = {stage: after["seconds"][stage] - before["seconds"].get(stage, 0.0) for stage in after["seconds"]}
+	record = dict(protocol=engine.name if engine else "E91", topology=G.get_name(), nodes=len(G.get_nodes()), trusted=" ".join([str(t) for t in G.get_trusted()]),
+			seed=str(seed), scenario=str(scenario), rounds=i, key_bits=maxflow, errors=errors, key_rate=maxflow/i,
+			paths=paths1, path_length=pathlength1/paths1 if paths1 else 0, channels=channels, decohered=decohered)
+	record.update([("time_" + stage, seconds[stage]) for stage in seconds])
+	if precision:
+		record.update(raw_rate=rate, raw_rate_ci=rate_ci, qber=qber, qber_ci=qber_ci,
+				precision=rate_ci/rate if rate else float("inf"), converged=converged(estimate, precision))
+	if sampler is not None:
+		record.update(key_rate=key_rate, key_rate_ci=key_rate_ci, raw_rate=rate, raw_rate_ci=rate_ci, qber=qber, qber_ci=qber_ci,
+				importance=importance)
+	if stats is not None:
+		# everything a result row needs beyond main's arguments
+		stats.update(record)
+	if tm.jsonl:
+		record.update(N=N, L=p, Q=q, E=d, Pz=Pz, Px=Px, router="global" if glob else "local", smart=not naive, metrics=after)
+		tm.emit(record)
 	return maxflow, errors
 
+SCREEN_ROUNDS = 1000 # rounds of routing that calibrate estimate_key_rate
+
+def routing_profile(G, P, rounds, glob, naive, seed, scenario = 0):
+	"""
+	The paths the router finds between trusted nodes, from `rounds` rounds of pair_ent and
+	routing alone: {(a, b): {(hops, weight): paths per round}} with a < b, where weight is the
+	path's summed edge weight (it needed p**weight of Bell pairs). G must have its paths set.
+	"""
+	trusted = G.get_trusted()
+	K = {i:{j: 0 for j in trusted} for i in trusted}
+	found = collections.defaultdict(collections.Counter)
+	for rng in RoundStreams(seed, scenario).rounds(0, rounds, len(G.get_all_edges())):
+		G1 = pair_ent(G, P, rng)
+		for path in (R1(G, G1, K, rng) if glob else local_R1(G, G1, K, naive, rng)):
+			if path[0] in trusted and path[-1] in trusted:
+				weight = sum([G.weight(path[k], path[k+1]) for k in range(len(path)-1)])
+				found[(min(path[0], path[-1]), max(path[0], path[-1]))][(len(path)-1, weight)] += 1/rounds
+	return {pair: dict(found[pair]) for pair in found}
+
+def trusted_links(G):
+	# (a, b, path) for every pair of trusted nodes a < b whose shortest path passes no other trusted node
+	trusted = G.get_trusted()
+	links = []
+	for a in sorted(trusted):
+		for b in sorted(trusted):
+			path = G.shortest_path(a, b) if a < b else ()
+			if path and not set(path[1:-1]) & set(trusted):
+				links.append((a, b, list(path)))
+	return links
+
+def distance_profile(G, p):
+	# routing_profile's guess from the distance table alone: every trusted link gets its path
+	# whenever all of its Bell pairs are there
+	profile = {}
+	for (a, b, path) in trusted_links(G):
+		weight = sum([G.weight(path[k], path[k+1]) for k in range(len(path)-1)])
+		profile[(a, b)] = {(len(path)-1, weight): p**weight}
+	return profile
+
+def estimate_key_rate(N, n, T, p, q, d, Pz = 1/2, Px = 1/2, glob=False, naive=False, calibration = SCREEN_ROUNDS, profile = None,
+		seed = None, scenario = 0):
+	"""
+	Semi-analytic stand-in for main(): expected paths, channels, raw bits, QBER and key bits of
+	N rounds, in a fraction of the time. Only routing is sampled, for `calibration` rounds
+	(none gives distance_profile's guess). Swapping, decoherence, sifting and R2 are taken in
+	expectation: a path of h hops becomes a channel with probability q**(h-1) and flips its bit
+	with probability (1-(1-d)**h)/2, and the key is the max flow over the distilled pair rates.
+	profile is a (p, routing_profile) from an earlier call; paths are scaled by (p/p0)**weight
+	to the new p, a first order guess that ignores how routes compete for Bell pairs. Taking
+	the QBER in expectation overestimates the key near the distillation threshold, the safe
+	side for screening sweeps. Returns (estimates with main()'s stats names, profile).
+	"""
+	(G,P,Q,D,K,Kb) = generate_network(n,T,p,q,d, CountPool)
+	if profile is None:
+		G.all_paths()
+		if seed is None:
+			seed = SEED if SEED is not None else np.random.SeedSequence().entropy
+		profile = (p, routing_profile(G, P, calibration, glob, naive, seed, scenario) if calibration else distance_profile(G, p))
+	(p0, pairs) = profile
+	sifted = Pz*Pz + Px*Px
+	paths = length = channels = decohered = 0.
+	raw = {}
+	for (a, b) in pairs:
+		(bits, errors) = (0., 0.)
+		for ((hops, weight), m) in pairs[(a, b)].items():
+			m = m * (p/p0)**weight if p0 else 0.
+			c = m * q**(hops-1)
+			e = c * (1-(1-d)**hops)/2
+			(paths, length, channels, decohered) = (paths + m, length + m*hops, channels + c, decohered + e)
+			(bits, errors) = (bits + N*sifted*c, errors + N*sifted*e)
+		raw[(a, b)] = (bits, errors)
+	# distillation and max flow as in R2_regular
+	start_nodes, end_nodes, capacities = [],[],[]
+	for a in K:
+		for b in K[a]:
+			(bits, errors) = raw.get((a, b), (0, 0))
+			start_nodes.append(a)
+			end_nodes.append(b)
+			capacities.append(max(0, int((1-2*binary_entropy(errors/bits))*bits)) if bits else 0)
+	key = maxflow(start_nodes, end_nodes, capacities, min(start_nodes), max(end_nodes))[0] if start_nodes else 0
+	bits = sum([x for (x, y) in raw.values()])
+	errors = sum([y for (x, y) in raw.values()])
+	return dict(key_bits=key, key_rate=key/N, raw_bits=bits, qber=errors/bits if bits else 0., paths=N*paths,
+			path_length=length/paths if paths else 0, channels=N*channels, decohered=N*decohered), profile
+
+EXACT_MAX_EDGES = 16 # exact_key_rate enumerates 2**edges Bell pair masks
+
+def exact_routing(G, glob, naive):
+	"""
+	{live: {paths: probability}} of what routing does in a round whose Bell pairs are the live
+	bitset, for every mask exact_key_rate has met on graphs with G's edges and trusted nodes.
+	Global routing is deterministic. Local routing's random choices are expanded from
+	local_routing_table's trees, each node's choice independent of the others.
+	"""
+	return G._routes.setdefault(("exact", tuple(G.get_trusted()), glob, naive), {})
+
+def _choices(tree, chance = 1.):
+	# (swaps, probability) of every leaf of a local_routing_table tree
+	if type(tree) is not tuple:
+		return [(tuple([tuple(x) for x in tree]), chance)]
+	return [leaf for branch in tree for leaf in _choices(branch, chance / len(tree))]
+
+def exact_routes(G, live, glob, naive):
+	# {paths: probability} of routing a round whose Bell pairs are live, memoized in exact_routing
+	routes = exact_routing(G, glob, naive)
+	if live in routes:
+		return routes[live]
+	G1 = G.live_copy(live)
+	trusted = G.get_trusted()
+	if glob:
+		outcomes = {tuple([tuple(path) for path in R1(G, G1, None, None)]): 1.}
+	else:
+		table = local_routing_table(G, naive)
+		swaps = {(): 1.}
+		for (node, mask) in zip(G.get_nodes(), neighbor_masks(G, G1)):
+			if not mask or node in trusted:
+				continue
+			if mask < 0:
+				mask = sum([1 << j for (j, (v, k)) in enumerate(G._nbrs[G._pos[node]]) if live >> k & 1])
+				tree = _local_decisions(G, node, mask, naive)
+			else:
+				tree = table.get((node, mask))
+				if tree is None:
+					tree = table[(node, mask)] = _local_decisions(G, node, mask, naive)
+			merged = collections.defaultdict(float)
+			for (done, chance) in swaps.items():
+				for (choice, odds) in _choices(tree):
+					merged[done + choice] += chance * odds
+			swaps = merged
+		outcomes = collections.defaultdict(float)
+		for (done, chance) in swaps.items():
+			outcomes[tuple(sorted([tuple(path) for path in stitch_paths(done, trusted)]))] += chance
+		outcomes = dict(outcomes)
+	routes[live] = outcomes
+	return outcomes
+
+def exact_key_rate(N, n, T, p, q, d, Pz = 1/2, Px = 1/2, glob=False, naive=False):
+	"""
+	estimate_key_rate's numbers with no sampling at all, for topologies of up to
+	EXACT_MAX_EDGES edges: every Bell pair mask is weighed by its probability under P, routed
+	once (exact_routes, tie-breaks included) and path_ent, sifting and decoherence are taken in
+	expectation. Paths, channels, raw bits and errors are exact expectations over N rounds;
+	qber is their ratio and the key is the max flow over the distilled pair rates of
+	distilled_rate, the key rate main() tends to as N grows.
+	"""
+	(G,P,Q,D,K,Kb) = generate_network(n,T,p,q,d, CountPool)
+	free = _bit_indices(G.get_live())
+	if len(free) > EXACT_MAX_EDGES:
+		raise ValueError("exact enumeration covers at most {} edges, not {}".format(EXACT_MAX_EDGES, len(free)))
+	G.all_paths()
+	probs = edge_probabilities(G, P)
+	# the chance of every mask, bit j of the index standing for the edge free[j]
+	chance = np.ones(1)
+	for k in free:
+		chance = np.concatenate([chance * (1-probs[k]), chance * probs[k]])
+	outcomes = collections.defaultdict(float)
+	for i in np.flatnonzero(chance):
+		live = sum([1 << free[j] for j in _bit_indices(int(i))])
+		for (paths, odds) in exact_routes(G, live, glob, naive).items():
+			outcomes[paths] += chance[i] * odds
+	trusted = G.get_trusted()
+	pairs = [(a, b) for a in K for b in K[a] if a < b]
+	raw = {pair: [0., 0.] for pair in pairs}
+	sifted = Pz*Pz + Px*Px
+	paths = length = channels = decohered = 0.
+	for (routed, chance) in outcomes.items():
+		for path in routed:
+			if path[0] not in trusted or path[-1] not in trusted:
+				continue
+			(suc, dep) = path_odds(Q, D, path)
+			(paths, length, channels, decohered) = (paths + chance, length + chance*(len(path)-1), channels + chance*suc, decohered + chance*suc*(1-dep))
+			bits = raw[(min(path[0], path[-1]), max(path[0], path[-1]))]
+			bits[0] += chance * sifted * suc
+			bits[1] += chance * sifted * suc * (1-dep)
+	rate = distilled_rate(pairs, [raw[pair][0] for pair in pairs], [raw[pair][1] for pair in pairs])
+	bits = sum([x for (x, y) in raw.values()])
+	errors = sum([y for (x, y) in raw.values()])
+	return {k: float(v) for (k, v) in dict(key_bits=N*rate, key_rate=rate, raw_bits=N*bits, qber=errors/bits if bits else 0.,
+			paths=N*paths, path_length=length/paths if paths else 0, channels=N*channels, decohered=N*decohered).items()}
+
+THREE_STAGE_BURST = 10 # photons per Three-Stage burst, ThreeStageNetwork.m's default (Fig 2 of the paper)
+THREE_STAGE_STAGES = 3 # fiber crossings of a Three-Stage key bit
+ONE_STAGE_PER_ROUND = False # Three-Stage runs all stages in one round unless set, as in ThreeStageNetwork.m
+DECOY_BURST = 2 # photons of a Decoy-State multi photon pulse, DecoyStateNetwork.m's default
+DECOY_SLOTS = 26 # length of DecoyStateNetwork.m's photon number cycle
+
+class ProtocolEngine:
+	"""
+	The round of Network.m for the protocols of networks/*.m that are not main()'s own E91.
+	Every edge sends a burst of photons and has its Bell pair if any of them arrive
+	(pair_ent), paths are routed as for E91, a path's swaps succeed with the product of Q
+	over its inner nodes (swap) and every swapped link then tries a key exchange, which
+	gives a key bit that is wrong unless the link's state kept (exchange). Subclasses
+	override transmission(), key_exchange() and no_decoherence() the way the MATLAB classes
+	override isTransmissionSuccessful, isKeyExchangeSuccessful and noDecoherenceProb, and
+	end_round() where they extend runRound. Whatever they carry from round to round goes
+	into main()'s checkpoints through state() and restore().
+	"""
+	name = None
+	burst = 1
+
+	def setup(self, G, P, Q, D, Pz, Px):
+		self.edges = G.get_all_edges()
+		self.edge_index = {e: k for (k, e) in enumerate(self.edges)}
+		self.probs = edge_probabilities(G, P)
+		self.segments = np.array([G.weight(u, v) for (u, v) in self.edges], dtype=np.int64)
+		trusted = sorted(G.get_trusted())
+		self.pairs = [(a, b) for a in trusted for b in trusted if a < b]
+		self.pair_index = {pair: k for (k, pair) in enumerate(self.pairs)}
+		self.sifted = Pz*Pz + Px*Px
+
+	def state(self):
+		return {}
+
+	def restore(self, state):
+		pass
+
+	def transmission(self, r):
+		# chance each edge gets its Bell pair in round r: one of burst photons arriving
+		return 1 - (1 - self.probs)**self.burst
+
+	def key_exchange(self, path, keep, rng):
+		# the two ends measured in matching bases
+		return rng.random() <= self.sifted
+
+	def no_decoherence(self, path, keep):
+		# keep is path_odds' chance that the path's Bell pairs kept their state
+		return keep
+
+	def end_round(self):
+		pass
+
+	def pair_ent(self, G, rng):
+		# createBellStates
+		return G.live_copy(mask_to_live(rng.edges < self.transmission(rng.round)))
+
+	def swap(self, G, Q, D, Pt, rng):
+		# performEntanglementSwapping: the paths whose Bell measurements all succeed, and the
+		# graph of trusted nodes they link
+		links = [path for path in Pt if rng.ent.random() <= path_odds(Q, D, path)[0]]
+		G2 = G.live_copy(0)
+		G2.set_nodes(G.get_trusted())
+		G2.set_edges([(path[0], path[-1]) for path in links])
+		return G2, links
+
+	def exchange(self, links, Q, D, K, Kb, rng):
+		# performKeyExchange: (a, b, wrong) for every swapped link, wrong is 0 where no key bit came out
+		Ed = []
+		for path in links:
+			(i, j) = (min(path[0], path[-1]), max(path[0], path[-1]))
+			keep = path_odds(Q, D, path)[1]
+			wrong = 0
+			if self.key_exchange(path, keep, rng.qkd):
+				K[i][j] += 1
+				wrong = int(rng.qkd.random() > self.no_decoherence(path, keep))
+				Kb[i][j].append(wrong)
+			Ed.append((i, j, wrong))
+		return Ed
+
+class ThreeStage(ProtocolEngine):
+	"""
+	ThreeStageNetwork.m. The burst crosses the fiber once per stage, each stage sending on
+	what arrived of the last, and a stage that loses every photon fails the edge. By default
+	all stages run in one round, so a photon has to cross stages times: the edge gets its Bell
+	pair with chance 1 - (1 - P**stages)**burst, the chained binomial draws taken as one draw
+	per edge. Every swapped link gives a key bit (no basis sifting), which keeps its state with
+	chance keep**stages.
+	With one_stage_per_round each edge sends its available photons (burst times its fiber
+	segments) once a round, and a pair of trusted nodes moves a stage on for every link it
+	gets. The link that finds the pair at the last stage gives the key bit, kept with the
+	product of the stages' keep, and a pair that gets no link in a round starts over. This
+	follows the MATLAB bookkeeping step for step, down to the stage moving on to 2 with the
+	link that gave the bit. ThreeStageNetwork.m itself stops in this mode (it writes
+	AvailableQubits, declared as AvailalbeQubits, and resets it to an undefined value); the
+	reset here is to the edge's first value.
+	"""
+	name = "Three-Stage"
+
+	def __init__(self, burst = THREE_STAGE_BURST, one_stage_per_round = ONE_STAGE_PER_ROUND, stages = THREE_STAGE_STAGES):
+		self.burst = burst
+		self.one_stage_per_round = one_stage_per_round
+		self.stages = stages
+
+	def __repr__(self):
+		return "ThreeStage(burst={!r}, one_stage_per_round={!r}, stages={!r})".format(self.burst, self.one_stage_per_round, self.stages)
+
+	def setup(self, G, P, Q, D, Pz, Px):
+		ProtocolEngine.setup(self, G, P, Q, D, Pz, Px)
+		# per edge photons (AvailableQubits), and per pair the stage (0 before the pair's first
+		# link) and the chance the stages so far kept their state (LinkDecoherence)
+		self.available = self.burst * self.segments
+		self.stage = np.zeros(len(self.pairs), dtype=np.int64)
+		self.decoherence = np.ones(len(self.pairs))
+		self._previous = self.stage.copy()
+
+	def state(self):
+		return {"available": self.available, "stage": self.stage, "decoherence": self.decoherence}
+
+	def restore(self, state):
+		self.available = state["available"].astype(np.int64)
+		self.stage = state["stage"].astype(np.int64)
+		self.decoherence = state["decoherence"].astype(float)
+
+	def transmission(self, r):
+		if self.one_stage_per_round:
+			return 1 - (1 - self.probs)**self.available
+		return 1 - (1 - self.probs**self.stages)**self.burst
+
+	def pair_ent(self, G, rng):
+		# the round starts here, so runRound's copy of the stages is taken
+		self._previous = self.stage.copy()
+		return ProtocolEngine.pair_ent(self, G, rng)
+
+	def key_exchange(self, path, keep, rng):
+		if not self.one_stage_per_round:
+			return True
+		k = self.pair_index[(min(path[0], path[-1]), max(path[0], path[-1]))]
+		if self.stage[k] == 0:
+			self.stage[k] = 1
+		done = self.stage[k] == self.stages
+		if done:
+			self._clear(k)
+		self.stage[k] += 1
+		self.decoherence[k] *= keep
+		return bool(done)
+
+	def no_decoherence(self, path, keep):
+		if not self.one_stage_per_round:
+			return keep**self.stages
+		return self.decoherence[self.pair_index[(min(path[0], path[-1]), max(path[0], path[-1]))]]
+
+	def end_round(self):
+		# pairs that were under way and did not move on start over
+		if self.one_stage_per_round:
+			for k in np.flatnonzero((self._previous > 0) & (self._previous == self.stage)):
+				self._clear(k)
+
+	def _clear(self, k):
+		# clearKEXState
+		self.stage[k] = 1
+		self.decoherence[k] = 1.
+		e = self.edge_index.get(self.pairs[k])
+		if e is not None:
+			self.available[e] = self.burst * self.segments[e]
+
+class DecoyState(ProtocolEngine):
+	"""
+	DecoyStateNetwork.m. Each round every edge sends the same number of photons, the first
+	round burst and then the next slot of a cycle of DECOY_SLOTS photon numbers. A swapped
+	link gives a key bit when the receiver's basis guess is right (half the time), which
+	keeps its state as an E91 bit does.
+	The MATLAB comments ask for 15 empty, 10 single and 1 multi photon slots, but its ranges
+	start1s:start1s+numOf1s and startMultis:startMultis+numOfMultis each take one slot more,
+	so slots 16 to 26 hold one photon and the bursts land past the end of the cycle, where
+	its counter never goes. The cycle here is the one it runs.
+	"""
+	name = "Decoy-State"
+
+	def __init__(self, burst = DECOY_BURST, slots = DECOY_SLOTS):
+		self.burst = burst
+		self.slots = slots
+		(multis, ones) = (1, 10)
+		zeros = slots - multis - ones
+		cycle = [0] * slots
+		cycle[zeros:zeros + ones + 1] = [1] * (ones + 1)
+		cycle[zeros + ones + 1:zeros + ones + multis + 2] = [burst] * (multis + 1)
+		self.cycle = tuple(cycle[:slots])
+
+	def __repr__(self):
+		return "DecoyState(burst={!r}, slots={!r})".format(self.burst, self.slots)
+
+	def transmission(self, r):
+		photons = self.burst if r == 0 else self.cycle[(r - 1) % self.slots]
+		return 1 - (1 - self.probs)**photons
+
+	def key_exchange(self, path, keep, rng):
+		return rng.random() <= .5
+
+PROTOCOLS = {"E91": None, "Three-Stage": ThreeStage, "Decoy-State": DecoyState}
+
 def write_data(filename, data):
 	with open(filename, "w+") as f:
 		f.write("L/N")
@@ -663,14 +2233,11 @@ def print_data(data0, data1):
 		print("")
 
 def print_and_write(string,file):
-	save = sys.stdout
-	
-	sys.stdout = file
-	print(string)
-	sys.stdout.flush()
-
-	sys.stdout = save
-	print(string)
+	# writes a line of results to file (if any) and logs it
+	if file is not None:
+		print(string, file=file)
+		file.flush()
+	log.info(string)
 
 def print_save_data(data_array, header_array, data_str, var, file):
 	print_and_write("\"{}\"".format(data_str), file)
@@ -682,124 +2249,351 @@ def print_save_data(data_array, header_array, data_str, var, file):
 
 	return
 
-def gather_data(glob, naive, fixed_len, N, size, L, Q, E, Pz, Px, var, file, asym = False):
-	
-	if var != "S":
-		Trusted0 = [0, size*size-1]
-		Trusted1 = [0, int((size*size-1)/2), size*size-1]
-		Trusted2 = [0, size-1, size*(size-1), size*size-1]
-		Trusted3 = [0, math.floor(size/3)*(size+1),size*size-1-math.floor(size/3)*(size+1), size*size-1]
-		Trusted4 = [0, int((size*size-1)/2)-size-1, int((size*size-1)/2), size*size-1]
-		Trusted5 = [0, (size+1)*2, (size*size-1)-(size+1)*2, size*size-1]
-		
-		
-		# Trusted0 = None
-		# # Trusted1 = None
-		# Trusted2 = None
-		# Trusted3 = None
-		# Trusted4 = None
-		# Trusted5 = None
-
-		#v = size
-		
+# Results as a table: one row per main() call with its parameters and metrics, appended to
+# numbered part files (or an HDF5 table) a buffer at a time.
+RESULT_FORMATS = {".npz": "npz", ".parquet": "parquet", ".h5": "hdf5", ".hdf5": "hdf5"}
+RESULT_MODULES = {"npz": [], "parquet": ["pyarrow"], "hdf5": ["pandas", "tables"]} # what each format needs to write
+
+def result_columns(rows):
+	# {column: array} for a list of row dicts; columns missing from a row are nan (or "" for text)
+	keys = []
+	for row in rows:
+		keys.extend([k for k in row if k not in keys])
+	columns = {}
+	for k in keys:
+		values = [row.get(k) for row in rows]
+		present = [v for v in values if v is not None]
+		if present and all([isinstance(v, (bool, np.bool_)) for v in present]) and len(present) == len(values):
+			columns[k] = np.array(values, dtype=bool)
+		elif present and all([isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) and -2**63 <= v < 2**63 for v in present]) and len(present) == len(values):
+			columns[k] = np.array(values, dtype=np.int64)
+		elif all([isinstance(v, (int, float, np.integer, np.floating)) for v in present]):
+			columns[k] = np.array([np.nan if v is None else float(v) for v in values])
+		else:
+			columns[k] = np.array(["" if v is None else str(v) for v in values])
+	return columns
+
+class ResultStore:
+	"""
+	Append-only result table. append() buffers rows (dicts of parameters and metrics) and every
+	`buffer` rows, and on close(), they are written at once: as a new part-NNNNN file in the
+	directory path (npz by default, parquet for a .parquet path) or appended to the table in an
+	.h5/.hdf5 file. Parquet needs pyarrow and HDF5 needs pandas with PyTables. Earlier parts are
+	never rewritten, so runs can keep adding to the same store. load_results reads it back.
+	"""
+	def __init__(self, path, format = None, buffer = 1000):
+		self.path = path
+		self.format = format or RESULT_FORMATS.get(os.path.splitext(path)[1].lower(), "npz")
+		self.buffer = buffer
+		self._rows = []
+		# checked here so a missing module fails before the run, not at the first flush
+		missing = [m for m in RESULT_MODULES[self.format] if importlib.util.find_spec(m) is None]
+		if missing:
+			raise ImportError("{} results need {}".format(self.format, " and ".join(missing)))
+		if self.format != "hdf5":
+			os.makedirs(path, exist_ok=True)
+			self._part = len([f for f in os.listdir(path) if f.startswith("part-")])
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def append(self, row):
+		self._rows.append(dict(row))
+		if len(self._rows) >= self.buffer:
+			self.flush()
+
+	def extend(self, rows):
+		for row in rows:
+			self.append(row)
+
+	def flush(self):
+		if not self._rows:
+			return
+		columns = result_columns(self._rows)
+		if self.format == "npz":
+			np.savez(os.path.join(self.path, "part-{:05d}.npz".format(self._part)), **columns)
+		elif self.format == "parquet":
+			import pyarrow
+			import pyarrow.parquet
+			pyarrow.parquet.write_table(pyarrow.table(columns), os.path.join(self.path, "part-{:05d}.parquet".format(self._part)))
+		else:
+			import pandas
+			text = [k for k in columns if columns[k].dtype.kind == "U"]
+			pandas.DataFrame(columns).to_hdf(self.path, key="results", format="table", append=True, min_itemsize={k: 64 for k in text})
+		if self.format != "hdf5":
+			self._part += 1
+		self._rows = []
+
+	def close(self):
+		self.flush()
+
+def load_results(path, columns = None):
+	# {column: array} of everything in a ResultStore, optionally only the named columns
+	if os.path.isdir(path):
+		parts = sorted([os.path.join(path, f) for f in os.listdir(path) if f.startswith("part-")])
+		if parts and parts[0].endswith(".parquet"):
+			import pyarrow.parquet
+			table = pyarrow.parquet.read_table(path, columns=columns)
+			return {k: table.column(k).to_numpy() for k in table.column_names}
+		data = [np.load(f) for f in parts]
+		sizes = [len(d[d.files[0]]) for d in data]
+		keys = []
+		for d in data:
+			keys.extend([k for k in d.files if k not in keys and (columns is None or k in columns)])
+		results = {}
+		for k in keys:
+			text = [d[k].dtype.kind == "U" for d in data if k in d.files][0]
+			# parts written without the column get nan (or "") for it
+			results[k] = np.concatenate([d[k] if k in d.files else np.full(size, "" if text else np.nan)
+					for (d, size) in zip(data, sizes)])
+		return results
+	import pandas
+	frame = pandas.read_hdf(path, key="results", columns=columns)
+	return {k: frame[k].to_numpy() for k in frame.columns}
+
+def scenario_row(args, stats):
+	# a result row from main()'s positional args and the stats it filled in
+	(N, n, T, p, q, d, Pz, Px, glob, naive) = args
+	row = dict(N=N, size=n if isinstance(n, int) else stats.get("nodes"), L=p, Q=q, E=d, Pz=Pz, Px=Px,
+			router="global" if glob else "local", smart=not naive)
+	row.update(stats)
+	return row
+
+LAYOUT_NAMES = ["NoTN", "Central", "Corner", "Diagonal", "Asym", "2Hops"]
+
+def trusted_layouts(size):
+	Trusted0 = [0, size*size-1]
+	Trusted1 = [0, int((size*size-1)/2), size*size-1]
+	Trusted2 = [0, size-1, size*(size-1), size*size-1]
+	Trusted3 = [0, math.floor(size/3)*(size+1),size*size-1-math.floor(size/3)*(size+1), size*size-1]
+	Trusted4 = [0, int((size*size-1)/2)-size-1, int((size*size-1)/2), size*size-1]
+	Trusted5 = [0, (size+1)*2, (size*size-1)-(size+1)*2, size*size-1]
+	return [Trusted0, Trusted1, Trusted2, Trusted3, Trusted4, Trusted5]
+
+def sweep_points(glob, naive, fixed_len, N, size, L, Q, E, Pz, Px, var):
+	# The main() calls behind one gather_data sweep, as (v, heading, [main args per trusted layout]).
 	alpha = .15
 	if var != "P" and var != "S":
 		P = 10**-(alpha*(L/size)/10) if fixed_len else 10**-(alpha*L/10)
 
-		#Trusted1 = [0, size*size-size, size*size-1]
-	t0 = {}
-	t1 = {}
-	t2 = {}
-	t3 = {}
-	t4 = {}
-	t5 = {}
-
-	# todo https://youtu.be/Psk2tWArczc
-	# todo touch base on Tue
-	# todo work on Global router with multiple trusted nodes
-	
-
+	points = []
 	if   var == "P":
 		data_str = "Data for {} iterations, {}x{} Grid, L = {}, Q = {}, E = {}, Pz = {}, Global Info = {}, TN Type = {}"\
 			.format(N, size, size, "var", Q, E, Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular" )
-		print(data_str)
 		for v in L:
 			P = 10**-(alpha*(v/size)/10) if fixed_len else 10**-(alpha*v/10)
-			print("L={}	P = {}".format(v, P))
-			print("       ",end=""); t0[v] = main(N,size, Trusted0, P, Q ,E, Pz, Px, glob, naive)
-			print("       ",end=""); t1[v] = main(N,size, Trusted1, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t2[v] = main(N,size, Trusted2, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t3[v] = main(N,size, Trusted3, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t4[v] = main(N,size, Trusted4, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t5[v] = main(N,size, Trusted5, P, Q, E, Pz, Px, glob, naive)
+			points.append((v, "L={}	P = {}".format(v, P), [(N,size, T, P, Q, E, Pz, Px, glob, naive) for T in trusted_layouts(size)]))
 	elif var == "Q":
 		data_str = "Data for {} iterations, {}x{} Grid, L = {}, Q = {}, E = {}, Pz = {}, Global Info = {}, TN Type = {}"\
 				.format(N, size, size, round(L,3), "var", E, Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular")
-		print(data_str)
 		for v in Q:
-			print("	Q = {}".format(v))
-			print("       ",end=""); t0[v] = main(N,size, Trusted0, P, v ,E, Pz, Px, glob, naive)
-			print("       ",end=""); t1[v] = main(N,size, Trusted1, P, v, E, Pz, Px, glob, naive)
-			print("       ",end=""); t2[v] = main(N,size, Trusted2, P, v, E, Pz, Px, glob, naive)
-			print("       ",end=""); t3[v] = main(N,size, Trusted3, P, v, E, Pz, Px, glob, naive)
-			print("       ",end=""); t4[v] = main(N,size, Trusted4, P, v, E, Pz, Px, glob, naive)
-			print("       ",end=""); t5[v] = main(N,size, Trusted5, P, v, E, Pz, Px, glob, naive)
+			points.append((v, "	Q = {}".format(v), [(N,size, T, P, v, E, Pz, Px, glob, naive) for T in trusted_layouts(size)]))
 	elif var == "E":
 		data_str = "Data for {} iterations, {}x{} Grid, L = {}, Q = {}, E = {}, Pz = {}, Global Info = {}, TN Type = {}"\
 			.format(N, size, size, round(L,3), Q, "var", Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular")
-		print(data_str)
 		for v in E:
-			print("	E = {}".format(v))
-			print("       ",end=""); t0[v] = main(N,size, Trusted0, P, Q ,v, Pz, Px, glob, naive)
-			print("       ",end=""); t1[v] = main(N,size, Trusted1, P, Q, v, Pz, Px, glob, naive)
-			print("       ",end=""); t2[v] = main(N,size, Trusted2, P, Q, v, Pz, Px, glob, naive)
-			print("       ",end=""); t3[v] = main(N,size, Trusted3, P, Q, v, Pz, Px, glob, naive)
-			print("       ",end=""); t4[v] = main(N,size, Trusted4, P, Q, v, Pz, Px, glob, naive)
-			print("       ",end=""); t5[v] = main(N,size, Trusted5, P, Q, v, Pz, Px, glob, naive)
+			points.append((v, "	E = {}".format(v), [(N,size, T, P, Q, v, Pz, Px, glob, naive) for T in trusted_layouts(size)]))
 	elif var == "S":
 		data_str = "Data for {} iterations, {}x{} Grid, L = {}, Q = {}, E = {}, Pz = {}, Global Info = {}, TN Type = {}"\
 			.format(N, "var", "var", L, Q, E, Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular")
-		print(data_str)
 		for v in size:
-			Trusted0 = [0, v*v-1]
-			Trusted1 = [0, int((v*v-1)/2), v*v-1]
-			Trusted2 = [0, v-1, v*(v-1), v*v-1]
-			Trusted3 = [0, math.floor(v/3)*(v+1),v*v-1-math.floor(v/3)*(v+1), v*v-1]
-			Trusted4 = [0, int((v*v-1)/2)-v-1, int((v*v-1)/2), v*v-1]
-			Trusted5 = [0, (v+1)*2, (v*v-1)-(v+1)*2, v*v-1]
-			if len(set(Trusted5)) == 3:
-				Trusted5 = [0, (v+1)*1, (v*v-1)-(v+1)*1, v*v-1]
-		
-			# Trusted0 = None
-			# Trusted1 = None
-			Trusted2 = None
-			Trusted3 = None
-			Trusted4 = None
-			Trusted5 = None
+			layouts = trusted_layouts(v)
+			if len(set(layouts[5])) == 3:
+				layouts[5] = [0, (v+1)*1, (v*v-1)-(v+1)*1, v*v-1]
+			# only NoTN and Central are run when varying the size
+			layouts[2:] = [None, None, None, None]
 
 			P = 10**-(alpha*(L/v)/10) if fixed_len else 10**-(alpha*L/10)
-			print("	Size = {}".format(v))
-			print("       ",end=""); t0[v] = main(N, v, Trusted0, P, Q ,E, Pz, Px, glob, naive)
-			print("       ",end=""); t1[v] = main(N, v, Trusted1, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t2[v] = main(N, v, Trusted2, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t3[v] = main(N, v, Trusted3, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t4[v] = main(N, v, Trusted4, P, Q, E, Pz, Px, glob, naive)
-			print("       ",end=""); t5[v] = main(N, v, Trusted5, P, Q, E, Pz, Px, glob, naive)
+			points.append((v, "	Size = {}".format(v), [(N, v, T, P, Q, E, Pz, Px, glob, naive) for T in layouts]))
 	elif var == None:
 		data_str = "Data for {} iterations, {}x{} Grid, L = {}, Q = {}, E = {}, Pz = {}, Global Info =  {}"\
 			.format(N, size, size, round(L,3), Q, E, Pz, glob if glob else "{}, Smart = {}".format(glob, not naive), "regular")
-		print(data_str)
-		v = "N/A"
-		print("       ",end=""); t0[v] = main(N,size, Trusted0, P, Q ,E, Pz, Px, glob, naive)
-		print("       ",end=""); t1[v] = main(N,size, Trusted1, P, Q, E, Pz, Px, glob, naive)
-		print("       ",end=""); t2[v] = main(N,size, Trusted2, P, Q, E, Pz, Px, glob, naive)
-		print("       ",end=""); t3[v] = main(N,size, Trusted3, P, Q, E, Pz, Px, glob, naive)
-		print("       ",end=""); t4[v] = main(N,size, Trusted4, P, Q, E, Pz, Px, glob, naive)
-		print("       ",end=""); t5[v] = main(N,size, Trusted5, P, Q, E, Pz, Px, glob, naive)
-
+		points.append(("N/A", None, [(N,size, T, P, Q, E, Pz, Px, glob, naive) for T in trusted_layouts(size)]))
 	else:
-		print("{} data is not supported, can only vary P, Q, E, or S")
-
+		data_str = "{} data is not supported, can only vary P, Q, E, or S".format(var)
+	return data_str, points
+
+def job_scenario(*key):
+	# Scenario number of one main() call in a sweep, so every job has its own streams under the
+	# sweep's seed whichever worker runs it and in whatever order.
+	return int(hashlib.sha256(repr(key).encode()).hexdigest()[:16], 16)
+
+@contextlib.contextmanager
+def captured_log(out):
+	# sends the simulator's log to out instead of its handlers while in the block
+	handler = logging.StreamHandler(out)
+	handler.setFormatter(logging.Formatter("%(message)s"))
+	propagate = log.propagate
+	log.addHandler(handler)
+	log.propagate = False
+	try:
+		yield
+	finally:
+		log.removeHandler(handler)
+		log.propagate = propagate
+
+def run_job(job):
+	# runs in a worker process; main()'s log is handed back so the parent can log it in order
+	# With a checkpoint directory, finished jobs leave their result there and are not run again,
+	# and unfinished ones resume from their main() checkpoint.
+	(args, seed, scenario, checkpoint_dir, options) = job
+	done = os.path.join(checkpoint_dir, "{}.json".format(scenario)) if checkpoint_dir else None
+	if done and os.path.exists(done):
+		with open(done) as f:
+			(result, text, row) = json.load(f)
+		return tuple(result), text, row
+	out = io.StringIO()
+	stats = {}
+	with captured_log(out):
+		result = main(*args, seed=seed, scenario=scenario, stats=stats,
+				checkpoint=os.path.join(checkpoint_dir, "{}.npz".format(scenario)) if checkpoint_dir else None, **options)
+	row = scenario_row(args, stats)
+	if done:
+		with open(done + ".tmp", "w") as f:
+			json.dump([result, out.getvalue(), row], f, default=int)
+		os.replace(done + ".tmp", done)
+	return result, out.getvalue(), row
+
+def splittable(job):
+	# whether run_rounds can split job: plain fixed length E91 rounds, which depend only on
+	# (seed, scenario, round) and carry no state from round to round but K and Kb
+	options = job[4]
+	return not (options.get("precision") or options.get("importance") or options.get("protocol") not in (None, "E91"))
+
+def run_rounds(job, r0, r1):
+	"""
+	Rounds r0 to r1-1 of a run_job job whose rounds are splittable, for spreading one main()
+	run over several workers. Returns the partial accumulators (r0, r1, counters, pools): the
+	path length, path, channel and decohered totals and {(a, b): (raw bits, key pool)} of the
+	pairs that got bits. merge_rounds() puts the parts back together.
+	"""
+	(args, seed, scenario, checkpoint_dir, options) = job
+	(N, n, T, p, q, d, Pz, Px, glob, naive) = args
+	(G,P,Q,D,K,Kb) = generate_network(n,T,p,q,d, CountPool if options.get("stats_only") else KeyPool)
+	G.all_paths()
+	(counters, G3) = play_rounds(G, P, Q, D, K, Kb, r0, r1, Pz, Px, glob, naive, RoundStreams(seed, scenario), Telemetry())
+	return r0, r1, counters, {(a, b): (K[a][b], Kb[a][b]) for a in K for b in K[a] if K[a][b]}
+
+def merge_rounds(job, parts):
+	# run_job's (result, text, row) for job from run_rounds parts covering rounds 0 to N-1; pools
+	# are joined in round order, so R2 and the result are exactly those of the whole run
+	(args, seed, scenario, checkpoint_dir, options) = job
+	(N, n, T, p, q, d, Pz, Px, glob, naive) = args
+	(G,P,Q,D,K,Kb) = generate_network(n,T,p,q,d, CountPool if options.get("stats_only") else KeyPool)
+	counters = [0, 0, 0, 0]
+	done = 0
+	for (r0, r1, totals, pools) in sorted(parts, key=lambda part: part[0]):
+		if r0 != done:
+			raise ValueError("rounds {} to {} are missing or run twice".format(min(done, r0), max(done, r0) - 1))
+		counters = [x + y for (x, y) in zip(counters, totals)]
+		for ((a, b), (bits, pool)) in pools.items():
+			K[a][b] += bits
+			if isinstance(pool, CountPool):
+				Kb[a][b].add_counts(len(pool), pool.count_ones())
+			else:
+				Kb[a][b].extend(pool.bits())
+		done = r1
+	if done != N:
+		raise ValueError("rounds {} to {} are missing".format(done, N - 1))
+	(pathlength1, paths1, channels, decohered) = counters
+	(maxflow, errors, K, Kb) = R2_regular(G, K, Kb, RoundStreams(seed, scenario).distill())
+	text = "Final Stats: {} rounds resulted in {} secret key bits with {} errors, from {} parts\n".format(N, maxflow, errors, len(parts))
+	stats = dict(protocol="E91", topology=G.get_name(), nodes=len(G.get_nodes()), trusted=" ".join([str(t) for t in G.get_trusted()]),
+			seed=str(seed), scenario=str(scenario), rounds=N, key_bits=maxflow, errors=errors, key_rate=maxflow/N,
+			paths=paths1, path_length=pathlength1/paths1 if paths1 else 0, channels=channels, decohered=decohered)
+	return (maxflow, errors), text, scenario_row(args, stats)
+
+def sweep_seed(seed, checkpoint_dir = None):
+	# The seed of a sweep: the one an earlier run saved in checkpoint_dir, else seed, else SEED or
+	# a fresh one, which is then saved there for reruns.
+	if checkpoint_dir:
+		os.makedirs(checkpoint_dir, exist_ok=True)
+		seed_file = os.path.join(checkpoint_dir, "seed")
+		if os.path.exists(seed_file):
+			with open(seed_file) as f:
+				saved = int(f.read())
+			if seed is not None and seed != saved:
+				raise ValueError("{} holds a sweep with seed {}, not {}".format(checkpoint_dir, saved, seed))
+			seed = saved
+	if seed is None:
+		seed = SEED if SEED is not None else np.random.SeedSequence().entropy
+	if checkpoint_dir and not os.path.exists(seed_file):
+		with open(seed_file, "w") as f:
+			f.write(str(seed))
+	log.info("Sweep seed %s", seed)
+	return seed
+
+def run_jobs(jobs, workers = 1):
+	# run_job's results for jobs, in order; with workers > 1 they are spread over a process pool
+	if workers > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+			return iter(list(pool.map(run_job, jobs, chunksize=1)))
+	return (run_job(job) for job in jobs)
+
+def run_sweeps(sweeps, workers = 1, seed = None, store = None, checkpoint_dir = None, precision = None, max_rounds = None, screen = None):
+	# sweeps is a list of (var, data_str, points) from sweep_points(). Every (trusted layout, value)
+	# pair of every sweep is one job; with workers > 1 they are spread over a process pool.
+	# Returns {var: [t0, ..., t5]} with t[v] = (maxflow, errors) as gather_data used to build them,
+	# and adds a row per job to store, if given. Rerunning with the same checkpoint_dir after a
+	# crash skips the jobs that finished and resumes the rest, under the seed the first run used.
+	# With a precision every job is an adaptive main() run, and its result is scaled to N rounds.
+	# With a screen, jobs that estimate_key_rate() gives fewer than screen key bits are not run:
+	# they get (0, 0) and a row of the estimates, marked screened.
+	options = dict(precision=precision, max_rounds=max_rounds) if precision else {}
+	seed = sweep_seed(seed, checkpoint_dir)
+	jobs = []
+	for (var, data_str, points) in sweeps:
+		for (v, heading, args) in points:
+			for t, a in enumerate(args):
+				jobs.append((a, seed, job_scenario(var, v, t), checkpoint_dir, options))
+	screened = {}
+	if screen is not None:
+		# one routing calibration per network, shared by the points that only change q, d, Pz or Px
+		profiles = {}
+		for (k, job) in enumerate(jobs):
+			(N, n, T, p, q, d, Pz, Px, glob, naive) = job[0]
+			if T is None:
+				# layouts main() skips are not estimated, they run as they are
+				continue
+			key = (n, tuple(T), p, glob, naive)
+			(estimate, profiles[key]) = estimate_key_rate(*job[0], profile=profiles.get(key), seed=seed, scenario=job[2])
+			if estimate["key_bits"] < screen:
+				screened[k] = estimate
+		log.info("Screened out %s of %s jobs", len(screened), len(jobs))
+	jobs = list(enumerate(jobs))
+	results = run_jobs([job for (k, job) in jobs if k not in screened], workers)
+	jobs = iter(jobs)
+
+	data = {}
+	for (var, data_str, points) in sweeps:
+		log.info(data_str)
+		data[var] = [{}, {}, {}, {}, {}, {}]
+		for (v, heading, args) in points:
+			if heading is not None:
+				log.info(heading)
+			for t in range(len(args)):
+				(k, job) = next(jobs)
+				if k in screened:
+					(result, text) = ((0, 0), "Screened out, estimated {:.1f} key bits\n".format(screened[k]["key_bits"]))
+					row = scenario_row(args[t], dict(screened[k], rounds=0, screened=True))
+				else:
+					(result, text, row) = next(results)
+				if text:
+					log.info("       " + text.rstrip("\n"))
+				# a layout main() skips (T is None) runs no rounds, so its result is passed on as it is
+				if precision and k not in screened and "rounds" in row:
+					result = tuple([int(round(x * args[t][0] / row["rounds"])) for x in result])
+				data[var][t][v] = result
+				if store is not None:
+					row.update(sweep=var, value=v, layout=LAYOUT_NAMES[t])
+					store.append(row)
+	return data
+
+def save_sweep(data_str, var, N, ts, file):
+	(t0, t1, t2, t3, t4, t5) = ts
 	err0 = {v: t0[v][1]/max(t0[v][0],1) if t0[v][0] > 0 else "N/A" for v in t0}
 	err1 = {v: t1[v][1]/max(t1[v][0],1) if t1[v][0] > 0 else "N/A" for v in t1}
 	err2 = {v: t2[v][1]/max(t2[v][0],1) if t2[v][0] > 0 else "N/A" for v in t2}
@@ -816,11 +2610,6 @@ def gather_data(glob, naive, fixed_len, N, size, L, Q, E, Pz, Px, var, file, asy
 
 	eff_rate0 = {v: key_rate0[v]*t0[v][0]/(4*N) for v in key_rate0}
 	eff_rate1 = {v: key_rate1[v]*t1[v][0]/(4*N) for v in key_rate1}
-	eff_rate2 = {v: key_rate2[v]*t2[v][0]/(4*N) for v in key_rate2}
-	eff_rate3 = {v: key_rate3[v]*t3[v][0]/(4*N) for v in key_rate3}
-	eff_rate4 = {v: key_rate4[v]*t4[v][0]/(4*N) for v in key_rate4}
-	eff_rate5 = {v: key_rate5[v]*t5[v][0]/(4*N) for v in key_rate5}
-
 
 	keybits_rate0 = {v: t0[v][0]/N for v in key_rate0}
 	keybits_rate1 = {v: t1[v][0]/N for v in key_rate1}
@@ -829,14 +2618,20 @@ def gather_data(glob, naive, fixed_len, N, size, L, Q, E, Pz, Px, var, file, asy
 	keybits_rate4 = {v: t4[v][0]/N for v in key_rate4}
 	keybits_rate5 = {v: t5[v][0]/N for v in key_rate5}
 
-	# header_array = ["keybits_rate0", "keybits_rate1", "keybits_rate2", "keybits_rate3","effective_keyrate0", "effective_keyrate1", "effective_keyrate2", "effective_keyrate3", "keyrate0", "keyrate1", "keyrate2", "keyrate3", "errrate0", "errate1","errrate2", "errate3", "keybits0, errors0", "keybits1, errors1", "keybits2, errors2", "keybits3, errors3"]
-	# data_array = [keybits_rate0, keybits_rate1, keybits_rate2, keybits_rate3,eff_rate0, eff_rate1, eff_rate2, eff_rate3, key_rate0, key_rate1,key_rate2, key_rate3, err0, err1,err2, err3, {p: t0[p][0] for p in t0},{p: t0[p][1] for p in t0}, {p: t1[p][0] for p in t1}, {p: t2[p][1] for p in t2}, {p: t3[p][0] for p in t3}]
-	header_array = ["NoTN", "Central", "Corner", "Diagonal", "Asym", "2Hops"]
+	header_array = LAYOUT_NAMES
 	data_array = [keybits_rate0, keybits_rate1, keybits_rate2, keybits_rate3, keybits_rate4, keybits_rate5]
 	print_save_data(data_array, header_array, data_str, var, file)
 	return eff_rate0, eff_rate1
 
-def gather_all_data(data_file, log_file):
+def gather_data(glob, naive, fixed_len, N, size, L, Q, E, Pz, Px, var, file, asym = False, workers = 1, seed = None, checkpoint_dir = None,
+		precision = None, max_rounds = None, screen = None):
+	# file is a text file for the CSV table or a ResultStore for a row per run
+	data_str, points = sweep_points(glob, naive, fixed_len, N, size, L, Q, E, Pz, Px, var)
+	store = file if isinstance(file, ResultStore) else None
+	data = run_sweeps([(var, data_str, points)], workers, seed, store, checkpoint_dir, precision, max_rounds, screen)
+	return save_sweep(data_str, var, N, data[var], None if store else file)
+
+def gather_all_data(data_file, log_file, workers = None, seed = None, checkpoint_dir = None, precision = None, max_rounds = None, screen = None):
 	N = 100000
 
 	size = 7
@@ -856,29 +2651,91 @@ def gather_all_data(data_file, log_file):
 	L_range = [1,3,5,10,15]
 	Q_range = [1,.95, .85, .75, .65][::-1]
 	E_range = [0, .02, .035, .05, .065]
+	# all four sweeps share one pool, so the slow points of one overlap with the rest
+	sweeps = [(var,) + sweep_points(glob, naive, fixed_len, N, s, l, q, e, Pz, Px, var) for (var, s, l, q, e) in
+			[("P", size, L_range, Q, E), ("Q", size, L, Q_range, E), ("E", size, L, Q, E_range), ("S", size_range, L, Q, E)]]
 	filename = "all"+data_file
+	if os.path.splitext(data_file)[1].lower() in RESULT_FORMATS:
+		with ResultStore(filename) as store:
+			data = run_sweeps(sweeps, workers or os.cpu_count(), seed, store, checkpoint_dir, precision, max_rounds, screen)
+		for (var, data_str, points) in sweeps:
+			save_sweep(data_str, var, N, data[var], None)
+		return
+	data = run_sweeps(sweeps, workers or os.cpu_count(), seed, checkpoint_dir=checkpoint_dir, precision=precision, max_rounds=max_rounds, screen=screen)
 	with open(filename, "w+") as f:
-		T0p, T1p = gather_data(glob, naive,fixed_len, N, size, L_range, Q, E, Pz, Px, "P", f)
-		T0q, T1q = gather_data(glob, naive,fixed_len, N, size, L, Q_range, E, Pz, Px, "Q", f)
-		T0e, T1e = gather_data(glob, naive,fixed_len, N, size, L, Q, E_range, Pz, Px, "E", f)
-		T0e, T1e = gather_data(glob, naive,fixed_len, N, size_range, L, Q, E, Pz, Px, "S", f)
+		for (var, data_str, points) in sweeps:
+			save_sweep(data_str, var, N, data[var], f)
+
+def failure_masks(G, rate, networks, seed, scenario = 0):
+	# (networks x nodes) boolean array, True where a node fails; each node fails with probability rate
+	prng = np.random.Generator(np.random.Philox(np.random.SeedSequence(seed, spawn_key=(scenario,))))
+	return prng.random((networks, len(G.get_nodes()))) < rate
+
+def run_failure_job(job):
+	# Runs in a worker process: every sample of one failure mask, so they share fail_nodes' table.
+	# Returns the key rate of each sample.
+	(G, failed, samples, args, seed) = job
+	Gf = fail_nodes(G, failed)
+	rows = []
+	for scenario in samples:
+		stats = {}
+		with captured_log(io.StringIO()):
+			main(args[0], Gf, None, *args[1:], seed=seed, scenario=scenario, stats=stats)
+		rows.append(scenario_row((args[0], Gf, None) + args[1:], stats))
+		rows[-1].update(failed=len(failed))
+	return rows
+
+def node_failure_sim(topologies, failure_range, networks, N, p, q, d, glob = False, naive = False, workers = None, seed = None, file = None):
+	"""
+	Node failure resilience, replacing NodeFailureSim*.m. For each topology and failure rate,
+	`networks` random sets of nodes fail (all their edges are removed) and main() runs N rounds
+	on what is left. Returns {topology name: {rate: mean key rate}}, also written to file as
+	CSV when one is given. Failure masks are drawn in bulk, samples with the same mask run as
+	one job on one distance table, and jobs are spread over `workers` processes (all cores by
+	default). file may also be a ResultStore, which gets a row per sample. topologies are
+	Topology objects with their trusted nodes set, p is one link success probability or one
+	per topology, and every sample uses its own scenario of the seed so the result does not
+	depend on the worker count.
+	"""
+	ps = list(p) if isinstance(p, (list, tuple)) else [p for G in topologies]
+	if seed is None:
+		seed = SEED if SEED is not None else np.random.SeedSequence().entropy
+	log.info("Node failure seed %s", seed)
+	jobs, where = [], []
+	for (t, G) in enumerate(topologies):
+		G = G.live_copy()
+		G.all_paths()
+		for rate in failure_range:
+			masks = failure_masks(G, rate, networks, seed, job_scenario("failure", t, rate))
+			(unique, inverse) = np.unique(masks, axis=0, return_inverse=True)
+			for (m, mask) in enumerate(unique):
+				samples = np.flatnonzero(inverse.ravel() == m)
+				failed = [G.get_nodes()[i] for i in np.flatnonzero(mask)]
+				jobs.append((G, failed, [job_scenario("failure", t, rate, int(k)) for k in samples], (N, ps[t], q, d, 1/2, 1/2, glob, naive), seed))
+				where.append((t, rate))
+	workers = workers or os.cpu_count()
+	if workers > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+			results = list(pool.map(run_failure_job, jobs, chunksize=max(1, len(jobs)//(8*workers))))
+	else:
+		results = [run_failure_job(job) for job in jobs]
+
+	totals = [{rate: 0 for rate in failure_range} for G in topologies]
+	store = file if isinstance(file, ResultStore) else None
+	for ((t, rate), rows) in zip(where, results):
+		totals[t][rate] += sum([row["key_rate"] for row in rows])
+		if store is not None:
+			for row in rows:
+				row.update(sweep="Failure", value=rate)
+				store.append(row)
+	data = {G.get_name(): {rate: totals[t][rate]/networks for rate in failure_range} for (t, G) in enumerate(topologies)}
+	data_str = "Node failures for {} networks x {} iterations, L = {}, Q = {}, E = {}, Global Info = {}"\
+			.format(networks, N, "/".join([str(round(x,3)) for x in ps]), q, d, glob if glob else "{}, Smart = {}".format(glob, not naive))
+	print_save_data(list(data.values()), list(data.keys()), data_str, "Failure", None if store else file)
+	return data
 
-import sys
-import uuid
-
-seed1 = uuid.uuid4()
-seed2 = uuid.uuid4()
-seed3 = uuid.uuid4()
-seed4 = uuid.uuid4()
-# seed1 = "9af02945-634d-4457-8059-24ee16a6ea36"
-# seed2 = "6ecd5129-cc03-4972-8330-d982e70ef7b8"
-# seed3 = "9965acb6-23ac-40f1-8508-00368225348d"
-# seed4 = "66e2caee-f28a-4c93-8318-97f8e3b6854a"
-print("seed1 ", seed1)
-print("seed2 ", seed2)
-print("seed3 ", seed3)
-print("seed4 ", seed4)
 if __name__ == '__main__':
+	set_log_level(logging.INFO)
 	BSM_rate = .85
 	fiber_length = 1 #km
 	transmit_prob =  10.**(-.15*fiber_length/10)
@@ -886,7 +2743,7 @@ if __name__ == '__main__':
 	its = 10000
 	#main(its, 3, [0,8], transmit_prob, BSM_rate, decoherence_prob, glob=True, naive = False)
 	#main(its, 5, [0,12,24], transmit_prob, BSM_rate, decoherence_prob, glob=True, naive = False)
-	main(its, 5, [0,24], transmit_prob, BSM_rate, decoherence_prob, glob=True, naive = False)
+	main(its, 5, [0,24], transmit_prob, BSM_rate, decoherence_prob, glob=True, naive = False, telemetry=Telemetry(progress=progress_bar))
 	#main(its, 7, [0,16,32,48], transmit_prob, BSM_rate, decoherence_prob, glob=True, naive = False)
 	
 	#gather_all_data("data.csv", "log_data.txt")
@@ -0,0 +1,234 @@
+#!/bin/python3
+
+"""
+Runs run_scenarios batches over several hosts, in place of splitting sweeps by hand into the
+*_VM1..4 copies. A coordinator hands out work units over TCP and workers on any host pull them:
+
+	SWEEP_AUTHKEY=... python sweep_cluster.py coordinator batch.toml [...] [--host 127.0.0.1] [--port 6150] [--unit-rounds 10000] [--timeout 600] [--local-workers 0]
+	SWEEP_AUTHKEY=... python sweep_cluster.py worker coordinator-host:6150
+
+A unit is a range of rounds of one job (simulator_clean.run_rounds) when its rounds are
+splittable, else the whole job (run_job). Workers send back each unit's partial accumulators,
+the path and channel totals and the per pair key pools, and the coordinator joins a job's
+parts in round order (merge_rounds), so the results are exactly those of run_scenarios.py.
+A unit whose worker fails, disconnects or takes longer than the timeout goes back in the
+queue; one that fails UNIT_ATTEMPTS times stops the run. --local-workers starts that many
+worker processes on the coordinator's host, which is also how to try it on one machine.
+
+Messages are pickled, so whoever can connect with the authkey can run code on the other end.
+Coordinator and workers share a secret authkey from the SWEEP_AUTHKEY environment variable (or
+--authkey); there is no default and neither side starts without one. The coordinator only
+listens on 127.0.0.1 unless --host says otherwise: exposing it to other hosts (--host 0.0.0.0
+or an interface's address) has to be asked for, and belongs on a trusted network. Checkpoint
+directories in the batches are ignored, as re-queued units take their place.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import simulator_clean as sim
+import run_scenarios
+
+PORT = 6150
+UNIT_ROUNDS = 10000 # rounds per work unit of a splittable job
+UNIT_TIMEOUT = 600 # seconds a worker gets for a unit before it is handed to another
+UNIT_ATTEMPTS = 3 # failures of one unit before the run stops
+
+def authkey(key = None):
+	# the shared secret, from key or SWEEP_AUTHKEY; there is no default
+	key = key or os.environ.get("SWEEP_AUTHKEY")
+	if not key:
+		raise ValueError("no authkey: set SWEEP_AUTHKEY or pass --authkey")
+	return key.encode()
+
+def work_units(jobs, unit_rounds = UNIT_ROUNDS):
+	# (job index, r0, r1) per unit, r0 and r1 None for a whole job
+	units = []
+	for (k, job) in enumerate(jobs):
+		N = job[0][0]
+		if sim.splittable(job) and N > unit_rounds:
+			units.extend([(k, r0, min(r0 + unit_rounds, N)) for r0 in range(0, N, unit_rounds)])
+		else:
+			units.append((k, None, None))
+	return units
+
+def run_unit(job, r0, r1):
+	return sim.run_job(job) if r0 is None else sim.run_rounds(job, r0, r1)
+
+class Coordinator:
+	"""
+	Hands the units of jobs (run_job jobs) to the workers that connect to address and merges
+	what they send back. run() returns run_job's (result, text, row) of every job, in order.
+	"""
+	def __init__(self, jobs, unit_rounds = UNIT_ROUNDS, timeout = UNIT_TIMEOUT, attempts = UNIT_ATTEMPTS):
+		# checkpoints stay with the coordinator, whose queue does their job
+		self.jobs = [(args, seed, scenario, None, options) for (args, seed, scenario, checkpoint_dir, options) in jobs]
+		self.units = work_units(self.jobs, unit_rounds)
+		self.timeout = timeout
+		self.attempts = attempts
+		self._queue = collections.deque(range(len(self.units)))
+		self._results = {}
+		self._failures = collections.Counter()
+		self._error = None
+		self._closed = False
+		self._done = threading.Condition()
+
+	def _next(self):
+		# the next unit to hand out, waiting while others are out; None once all are in
+		with self._done:
+			while not self._queue and len(self._results) < len(self.units) and self._error is None:
+				self._done.wait()
+			return self._queue.popleft() if self._queue and self._error is None else None
+
+	def _finish(self, u, result):
+		with self._done:
+			# a unit handed out twice only counts once
+			self._results.setdefault(u, result)
+			self._done.notify_all()
+
+	def _requeue(self, u, reason):
+		with self._done:
+			if u in self._results:
+				return
+			self._failures[u] += 1
+			sim.log.warning("Unit %s of job %s failed (%s), attempt %s", u, self.units[u][0], reason.strip().splitlines()[-1], self._failures[u])
+			if self._failures[u] >= self.attempts:
+				self._error = "unit {} failed {} times:\n{}".format(u, self._failures[u], reason)
+			else:
+				self._queue.appendleft(u)
+			self._done.notify_all()
+
+	def _serve(self, conn):
+		# one worker's connection: a unit at a time until the queue is done
+		u = None
+		try:
+			name = conn.recv()
+			sim.log.info("Worker %s connected", name)
+			while True:
+				u = self._next()
+				if u is None:
+					conn.send(("done",))
+					return
+				(k, r0, r1) = self.units[u]
+				conn.send(("unit", u, self.jobs[k], r0, r1))
+				if not conn.poll(self.timeout):
+					self._requeue(u, "timed out after {}s".format(self.timeout))
+					return
+				reply = conn.recv()
+				if reply[0] == "result":
+					self._finish(u, reply[2])
+				else:
+					self._requeue(u, reply[2])
+				u = None
+		except (EOFError, OSError) as e:
+			if u is not None:
+				self._requeue(u, "worker lost: {!r}".format(e))
+		finally:
+			conn.close()
+
+	def _accept(self, listener):
+		while True:
+			try:
+				conn = listener.accept()
+			except (OSError, EOFError, multiprocessing.AuthenticationError):
+				if self._closed:
+					return
+				continue
+			threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+	def run(self, address = ("127.0.0.1", PORT), key = None, local_workers = 0):
+		listener = Listener(address, authkey=authkey(key))
+		self.address = listener.address
+		sim.log.info("Coordinator on %s:%s, %s units of %s jobs", self.address[0], self.address[1], len(self.units), len(self.jobs))
+		threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+		workers = [multiprocessing.Process(target=worker, args=(("localhost", self.address[1]), key)) for k in range(local_workers)]
+		for p in workers:
+			p.start()
+		try:
+			with self._done:
+				while len(self._results) < len(self.units) and self._error is None:
+					self._done.wait()
+		finally:
+			self._closed = True
+			listener.close()
+			with self._done:
+				self._done.notify_all()
+			for p in workers:
+				p.join(5)
+				if p.is_alive():
+					p.terminate()
+		if self._error:
+			raise RuntimeError(self._error)
+		parts = collections.defaultdict(list)
+		whole = set()
+		for (u, (k, r0, r1)) in enumerate(self.units):
+			parts[k].append(self._results[u])
+			if r0 is None:
+				whole.add(k)
+		return [parts[k][0] if k in whole else sim.merge_rounds(job, parts[k]) for (k, job) in enumerate(self.jobs)]
+
+def worker(address, key = None, name = None):
+	# pulls units from the coordinator at address until it is done or gone
+	name = name or "{}-{}".format(os.uname().nodename if hasattr(os, "uname") else "worker", os.getpid())
+	while True:
+		try:
+			conn = Client(address, authkey=authkey(key))
+		except (ConnectionRefusedError, OSError):
+			# the coordinator is done (or not up)
+			return
+		try:
+			conn.send(name)
+			while True:
+				message = conn.recv()
+				if message[0] == "done":
+					return
+				(tag, u, job, r0, r1) = message
+				try:
+					reply = ("result", u, run_unit(job, r0, r1))
+				except Exception:
+					reply = ("error", u, traceback.format_exc())
+				conn.send(reply)
+		except (EOFError, OSError):
+			# dropped after a timeout; ask for new work
+			time.sleep(1)
+		finally:
+			conn.close()
+
+def main(files, host = "127.0.0.1", port = PORT, unit_rounds = UNIT_ROUNDS, timeout = UNIT_TIMEOUT, local_workers = 0, key = None):
+	def run(jobs):
+		return Coordinator(jobs, unit_rounds, timeout).run((host, port), key, local_workers)
+	return run_scenarios.main(files, run=run)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Runs run_scenarios batches on workers over TCP.")
+	commands = parser.add_subparsers(dest="command", required=True)
+	coordinator = commands.add_parser("coordinator", help="hand out the units of batch files")
+	coordinator.add_argument("files", nargs="+", help="batch files (.json or .toml)")
+	coordinator.add_argument("--host", default="127.0.0.1", help="address to listen on (default 127.0.0.1; 0.0.0.0 for every interface)")
+	coordinator.add_argument("--port", type=int, default=PORT, help="port to listen on (default {})".format(PORT))
+	coordinator.add_argument("--unit-rounds", type=int, default=UNIT_ROUNDS, help="rounds per work unit (default {})".format(UNIT_ROUNDS))
+	coordinator.add_argument("--timeout", type=float, default=UNIT_TIMEOUT, help="seconds per unit before it is re-queued (default {})".format(UNIT_TIMEOUT))
+	coordinator.add_argument("--local-workers", type=int, default=0, help="workers to start on this host (default 0)")
+	work = commands.add_parser("worker", help="run units for a coordinator")
+	work.add_argument("address", help="coordinator host:port")
+	for p in (coordinator, work):
+		p.add_argument("--authkey", help="shared key (default $SWEEP_AUTHKEY)")
+		p.add_argument("--log-level", default="INFO", help="simulator log level (default INFO)")
+	args = parser.parse_args()
+	sim.set_log_level(getattr(logging, args.log_level.upper()))
+	try:
+		authkey(args.authkey)
+	except ValueError as e:
+		parser.error(str(e))
+	if args.command == "coordinator":
+		main(args.files, args.host, args.port, args.unit_rounds, args.timeout, args.local_workers, args.authkey)
+	else:
+		(host, port) = args.address.rsplit(":", 1)
+		worker((host, int(port)), args.authkey)
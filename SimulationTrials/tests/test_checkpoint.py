@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+N = 1000
+
+class Crash(Exception):
+	pass
+
+def run(checkpoint, crash = None, **options):
+	# main() on a 5x5 grid, stopped by an exception at round crash
+	def progress(done, total):
+		if done == crash:
+			raise Crash()
+	stats = {}
+	try:
+		result = sim.main(N, 5, [0, 12, 24], .95, .85, .02, seed=4, stats=stats, checkpoint=checkpoint, checkpoint_every=250,
+				telemetry=sim.Telemetry(progress), **options)
+	except Crash:
+		return None
+	return result, dict([(k, v) for (k, v) in stats.items() if not k.startswith("time_")])
+
+def saved(checkpoint):
+	with np.load(checkpoint) as data:
+		return dict([(name, data[name].tolist()) for name in data.files])
+
+def test_resume_is_bit_identical(tmp_path):
+	for options in [dict(glob=True), dict(glob=False), dict(stats_only=True), dict(protocol=sim.ThreeStage(10, True))]:
+		(straight, resumed) = (str(tmp_path / "straight.npz"), str(tmp_path / "resumed.npz"))
+		# both stop after the checkpoint at round 750, one of them having resumed from round 500
+		assert run(straight, 800, **options) is None
+		assert run(resumed, 600, **options) is None
+		assert saved(resumed)["round"] == 500
+		assert run(resumed, 800, **options) is None
+		assert saved(resumed) == saved(straight)
+		result = run(straight, **options)
+		assert run(resumed, **options) == result == run(None, **options)
+		assert not os.path.exists(straight) and not os.path.exists(resumed)
@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+import sweep_cluster
+
+def job(glob, stats_only = False, N = 1000):
+	return ((N, 5, [0, 12, 24], .95, .85, .02, 1/2, 1/2, glob, False), 9, sim.job_scenario(glob, stats_only), None, dict(stats_only=stats_only))
+
+def same(merged, whole):
+	# everything but the stage times, which only run_job's rows have
+	rows = [dict([(k, v) for (k, v) in row.items() if not k.startswith("time_")]) for (result, text, row) in (merged, whole)]
+	return merged[0] == whole[0] and rows[0] == rows[1]
+
+def test_merged_rounds_match_run_job():
+	for glob in (True, False):
+		for stats_only in (False, True):
+			j = job(glob, stats_only)
+			parts = [sim.run_rounds(j, r0, r1) for (r0, r1) in [(300, 700), (0, 300), (700, 1000)]]
+			assert same(sim.merge_rounds(j, parts), sim.run_job(j))
+
+def test_coordinator_matches_single_host():
+	# two local workers over TCP; the short job is not split
+	jobs = [job(True), job(False), job(False, True, 200)]
+	results = sweep_cluster.Coordinator(jobs, unit_rounds=300).run(("127.0.0.1", 0), "test", local_workers=2)
+	assert all([same(merged, sim.run_job(j)) for (merged, j) in zip(results, jobs)])
@@ -0,0 +1,21 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+N = 10000
+
+def test_exact_key_rate_matches_monte_carlo():
+	for glob in (True, False):
+		for (T, p) in [([0, 8], .9), ([0, 4, 8], .8)]:
+			exact = sim.exact_key_rate(N, 3, T, p, .85, .02, glob=glob)
+			(stats, tm) = ({}, sim.Telemetry())
+			sim.main(N, 3, T, p, .85, .02, glob=glob, seed=2, stats=stats, telemetry=tm)
+			stats["raw_bits"] = tm.counters["raw_bits"]
+			# a round adds at most four of each, so a total's variance is at most four times its mean
+			for name in ("paths", "channels", "decohered", "raw_bits"):
+				assert abs(stats[name] - exact[name]) <= 4 * math.sqrt(4 * exact[name]), (glob, T, name)
+			# the distilled key of one run spreads by about 3% between seeds here
+			assert abs(stats["key_bits"] - exact["key_bits"]) <= .12 * exact["key_bits"], (glob, T)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+N = 4000
+
+def test_importance_sampling_is_unbiased():
+	# a 3x3 grid is small enough for exact_key_rate's expectations
+	for glob in (True, False):
+		for p in (.5, .3):
+			exact = sim.exact_key_rate(N, 3, [0, 8], p, .85, .02, glob=glob)
+			for seed in range(2):
+				stats = {}
+				sim.main(N, 3, [0, 8], p, .85, .02, glob=glob, seed=seed, stats=stats, importance=.5, confidence=.999)
+				assert abs(stats["raw_rate"] - exact["raw_bits"]/N) <= stats["raw_rate_ci"]
+				assert abs(stats["key_rate"] - exact["key_rate"]) <= stats["key_rate_ci"]
@@ -0,0 +1,76 @@
+import collections
+import os
+import sys
+from copy import deepcopy
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+def run(stats_only, glob):
+	stats = {}
+	result = sim.main(500, 5, [0, 12, 24], .95, .85, .02, glob=glob, seed=3, stats_only=stats_only, stats=stats)
+	return result, dict([(k, v) for (k, v) in stats.items() if not k.startswith("time_")])
+
+def test_stats_only_matches_key_pools():
+	for glob in (True, False):
+		(bits, stats) = run(False, glob)
+		assert bits[0] > 0
+		assert run(True, glob) == (bits, stats)
+
+def random_pools(seed, trusted = (0, 1, 2, 3)):
+	# raw key strings between every pair of trusted nodes, as the baseline kept them
+	rng = np.random.default_rng(seed)
+	K = {i: {j: 0 for j in trusted} for i in trusted}
+	Kb = {i: {j: "" for j in trusted} for i in trusted}
+	for i in trusted:
+		for j in trusted:
+			if i < j:
+				Kb[i][j] = "".join([str(int(x)) for x in rng.random(int(rng.integers(40, 200))) < rng.uniform(0, .1)])
+				K[i][j] = len(Kb[i][j])
+	return K, Kb
+
+def string_R2(K, Kb):
+	# R2_regular on string pools: privacy amplification, then each path of the max flow relays
+	# its bits by XOR from the front of every hop's pool
+	for i in K:
+		for j in K:
+			if K[i][j]:
+				K[i][j] = max(0, int((1-2*sim.binary_entropy(Kb[i][j].count("1")/K[i][j]))*K[i][j]))
+				Kb[i][j] = "0"*K[i][j]
+	pairs = [(i, j) for i in K for j in K[i]]
+	(source, sink) = (min(K), max(K))
+	(value, flows) = sim.maxflow([i for (i, j) in pairs], [j for (i, j) in pairs], [K[i][j] for (i, j) in pairs], source, sink)
+	arcs = collections.Counter()
+	for (pair, flow) in zip(pairs, flows):
+		arcs[pair] += flow
+	for (path, n) in sim.decompose_flow(arcs, source, sink):
+		hops = [Kb[path[k]][path[k+1]][:n] for k in range(len(path)-1)]
+		for k in range(len(path)-1):
+			Kb[path[k]][path[k+1]] = Kb[path[k]][path[k+1]][n:]
+			K[path[k]][path[k+1]] -= n
+		if len(path) > 2:
+			Kb[source][sink] += "".join([str(sum([int(h[b]) for h in hops]) % 2) for b in range(n)])
+	errors = Kb[source][sink].count("1")
+	Kb[source][sink] = ""
+	return value, errors, K, Kb
+
+def test_R2_pools_match_strings():
+	for seed in range(5):
+		(K, Kb) = random_pools(seed)
+		expected = string_R2(deepcopy(K), deepcopy(Kb))
+		for pool in (sim.KeyPool, sim.CountPool):
+			pools = {i: {j: pool([int(b) for b in Kb[i][j]]) for j in Kb[i]} for i in Kb}
+			(value, errors, K2, Kb2) = sim.R2_regular(None, deepcopy(K), pools, sim.RoundStreams(seed).distill())
+			assert (value, errors, K2) == expected[:3]
+			assert all([len(Kb2[i][j]) == len(expected[3][i][j]) for i in Kb2 for j in Kb2[i]])
+
+def test_relay_path_matches_strings():
+	(K, Kb) = random_pools(7)
+	pools = {i: {j: sim.KeyPool([int(b) for b in Kb[i][j]]) for j in Kb[i]} for i in Kb}
+	sim.relay_path(pools, [0, 1, 2, 3], 30, None)
+	hops = [Kb[0][1], Kb[1][2], Kb[2][3]]
+	relayed = "".join([str(sum([int(h[b]) for h in hops]) % 2) for b in range(30)])
+	assert str(pools[0][3]) == Kb[0][3] + relayed
+	assert [str(pools[i][i+1]) for i in range(3)] == [h[30:] for h in hops]
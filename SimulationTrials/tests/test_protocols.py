@@ -0,0 +1,40 @@
+import csv
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+RESULTS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "results", "topologies")
+ROUNDS = 10000 # TopologiesSim.m's TOTAL_ROUNDS
+
+def three_stage_burst(L, burst, seed = 1):
+	# one point of the "3-stage-burst" scenario, as three_stage_burst.py runs it
+	link = sim.adjacency_topology([[0, 1], [1, 0]], [0, 1], "A - B")
+	(bits, errors) = sim.main(ROUNDS, link, None, 10**(-.15*L/10), .85, .02, glob=True, seed=seed, protocol=sim.ThreeStage(burst))
+	return bits / ROUNDS
+
+def key_rate_se(L, burst):
+	# standard error of a ROUNDS round key rate: a key bit comes with chance s and is wrong
+	# with chance e, and the rate s*(1-2h(e)) is taken to first order in both
+	s = 1 - (1 - 10**(-.15*L/10)**3)**burst
+	e = 1 - .99**3
+	slope = 2*math.log2((1-e)/e)
+	return math.sqrt(((1 - 2*sim.binary_entropy(e))**2 * s*(1-s) + s * slope**2 * e*(1-e)) / ROUNDS)
+
+def test_three_stage_burst_matches_matlab():
+	with open(os.path.join(RESULTS, "3-stage-burst_L.csv")) as f:
+		table = list(csv.DictReader(f))
+	for (L, burst) in [(1, 1), (10, 10), (20, 5), (30, 20), (40, 15), (60, 10)]:
+		stored = float(table[L-1]["Burst{}".format(burst)])
+		# both are Monte Carlo estimates of ROUNDS rounds
+		assert abs(three_stage_burst(L, burst) - stored) <= 4 * math.sqrt(2) * key_rate_se(L, burst), (L, burst)
+
+def test_three_stage_burst_grows_with_burst():
+	rates = [three_stage_burst(20, burst) for burst in [1, 5, 10, 15, 20]]
+	assert rates == sorted(rates) and rates[0] < rates[-1]
+
+def test_decoy_state_cycle():
+	# DecoyStateNetwork.m's ranges put 11 single photon slots after 15 empty ones
+	assert sim.DecoyState().cycle == (0,) * 15 + (1,) * 11
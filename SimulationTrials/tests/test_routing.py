@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+def test_local_tables_match_R1_find_best_links():
+	(G,P,Q,D,K,Kb) = sim.generate_network(7, [0, 24, 48], .9, .85, .02)
+	G.all_paths()
+	streams = sim.RoundStreams(5)
+	edges = len(G.get_all_edges())
+	checked = 0
+	for r in range(40):
+		G1 = sim.pair_ent(G, P, streams.round(r, edges))
+		masks = sim.neighbor_masks(G, G1)
+		for naive in (True, False):
+			for (node, mask) in zip(G.get_nodes(), masks):
+				if not mask or node in G.get_trusted():
+					continue
+				# the table walk and the direct call read the same routing stream
+				result = sim._local_decisions(G, node, mask, naive)
+				rng = streams.round(r, edges)
+				while type(result) is tuple:
+					result = rng.ran.choice(result)
+				assert result == sim.R1_find_best_links(G, G1.live_copy(), K, node, naive, streams.round(r, edges))
+				checked += len(result) > 1
+	assert checked
+
+def test_local_R1_matches_R1_find_best_links():
+	# whole rounds, with one routing stream shared by every node as in local_R1
+	(G,P,Q,D,K,Kb) = sim.generate_network(7, [0, 24, 48], .9, .85, .02)
+	G.all_paths()
+	streams = sim.RoundStreams(6)
+	edges = len(G.get_all_edges())
+	for r in range(40):
+		G1 = sim.pair_ent(G, P, streams.round(r, edges))
+		for naive in (True, False):
+			rng = streams.round(r, edges)
+			Pt = []
+			for node in G.get_nodes():
+				if node not in G.get_trusted() and G1.get_neighbors(node):
+					Pt.extend(sim.R1_find_best_links(G, G1.live_copy(), K, node, naive, rng))
+			assert sim.local_R1(G, G1.live_copy(), K, naive, streams.round(r, edges)) == sim.stitch_paths(Pt, G1.get_trusted())
@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simulator_clean as sim
+
+def size_sweep(N = 200):
+	# gather_all_data's "S" sweep on small grids; its last four layouts are None
+	return [("S",) + sim.sweep_points(False, True, True, N, [3, 5], 10, .85, .02, .5, .5, "S")]
+
+def test_size_sweep_precision():
+	data = sim.run_sweeps(size_sweep(), seed=1, precision=.5, max_rounds=400)["S"]
+	for v in (3, 5):
+		assert all([isinstance(x, int) for x in data[0][v] + data[1][v]])
+		# layouts main() skips keep its result
+		assert [data[t][v] for t in range(2, 6)] == [(-1, 1)] * 4
+
+def test_size_sweep_screen():
+	sweeps = size_sweep()
+	data = sim.run_sweeps(sweeps, seed=1, screen=10**9)["S"]
+	for v in (3, 5):
+		# everything estimated is screened out, the None layouts still run
+		assert data[0][v] == data[1][v] == (0, 0)
+		assert [data[t][v] for t in range(2, 6)] == [(-1, 1)] * 4
+	assert sim.run_sweeps(sweeps, seed=1, screen=0)["S"] == sim.run_sweeps(sweeps, seed=1)["S"]
@@ -0,0 +1,42 @@
+#!/bin/python3
+
+"""
+The "3-stage-burst" scenario of TopologiesSim.m: Three-Stage key rate over a single fiber
+link between two trusted nodes, against the link length, for bursts of 1, 5, 10, 15 and 20
+photons.
+
+	python three_stage_burst.py [rounds] [max km] [seed]
+
+Writes results/topologies/3-stage-burst_L_<rounds>.csv, one column per burst.
+"""
+from __future__ import print_function
+import os
+import sys
+
+import simulator_clean as sim
+
+BURSTS = [1, 5, 10, 15, 20]
+
+def main(rounds = 10000, max_km = 80, seed = None):
+	link = sim.adjacency_topology([[0, 1], [1, 0]], [0, 1], "A - B")
+	lengths = list(range(1, max_km + 1))
+	rates = {}
+	for burst in BURSTS:
+		engine = sim.ThreeStage(burst)
+		for L in lengths:
+			(bits, errors) = sim.main(rounds, link, None, 10**(-.15*L/10), .85, .02, glob=True, seed=seed, protocol=engine)
+			rates[(burst, L)] = bits / rounds
+	filename = os.path.join("results", "topologies", "3-stage-burst_L_{}.csv".format(rounds))
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with open(filename, "w") as f:
+		print(",".join(["Burst{}".format(burst) for burst in BURSTS]), file=f)
+		for L in lengths:
+			print(",".join([str(rates[(burst, L)]) for burst in BURSTS]), file=f)
+	return rates
+
+if __name__ == '__main__':
+	rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	max_km = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+	seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+	sim.set_log_level()
+	main(rounds, max_km, seed)